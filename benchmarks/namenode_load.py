@@ -0,0 +1,110 @@
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+async def fake_datanode(reader, writer, delay):
+    """Answers every FTP command of the namenode with success after the delay."""
+    writer.write(b'220 ready\r\n')
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            command = line.decode().split(' ', 1)[0].upper().strip()
+            if command == 'USER':
+                writer.write(b'331 password\r\n')
+            elif command == 'PASS':
+                writer.write(b'230 logged in\r\n')
+            elif command == 'AVBL':
+                writer.write(b'213 Available size of / is: 1000000000000\r\n')
+            else:
+                await asyncio.sleep(delay)
+                writer.write(b'250 done\r\n')
+            await writer.drain()
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+    writer.close()
+
+
+async def request(host, port, path, args):
+    body = json.dumps(args).encode()
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(b'GET %s HTTP/1.0\r\nContent-Length: %d\r\n\r\n' % (path.encode(), len(body)) + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return json.loads(response.split(b'\r\n\r\n', 1)[1])['msg']
+
+
+async def worker(host, port, worker_id, count, latencies, errors):
+    for i in range(count):
+        if i % 4 == 0:
+            path, args = '/mkdir', {'dir_path': f'/bench/w{worker_id}-{i}'}
+        elif i % 4 == 1:
+            path, args = '/create', {'file_path': f'/bench/w{worker_id}-{i}'}
+        else:
+            path, args = '/ls', {'dir_path': '/'}
+        start = time.perf_counter()
+        try:
+            await request(host, port, path, args)
+            latencies.append(time.perf_counter() - start)
+        except (OSError, ValueError, IndexError):
+            errors.append(path)
+
+
+async def load(host, port, concurrency, requests):
+    await request(host, port, '/mkdir', {'dir_path': '/bench'})
+    latencies, errors = [], []
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(host, port, worker_id, requests // concurrency, latencies, errors)
+                           for worker_id in range(concurrency)))
+    return time.perf_counter() - start, sorted(latencies), errors
+
+
+def start_namenode(server, port, pool_size):
+    process = subprocess.Popen([sys.executable, 'run_namenode.py', '--ip', '127.0.0.1', '--port', str(port),
+                                '--lock_duration', '300', '--update_time', '200', '--num_replicas', '1',
+                                '--server', server, '--pool_size', str(pool_size),
+                                '--meta_dir', tempfile.mkdtemp()],
+                               cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    time.sleep(1.5)
+    return process
+
+
+async def benchmark(args):
+    if args.datanode_delay is not None:
+        await asyncio.start_server(lambda r, w: fake_datanode(r, w, args.datanode_delay), '127.0.0.1', 21)
+
+    for server in args.servers:
+        process = start_namenode(server, args.port, args.pool_size)
+        try:
+            if args.datanode_delay is not None:
+                await request('127.0.0.1', args.port, '/add_node', {})
+            elapsed, latencies, errors = await load('127.0.0.1', args.port, args.concurrency, args.requests)
+        finally:
+            process.terminate()
+            process.wait()
+        done = len(latencies)
+        p50 = latencies[done // 2] * 1000 if done else 0
+        p99 = latencies[min(done - 1, done * 99 // 100)] * 1000 if done else 0
+        print(f'{server:9}: {done / elapsed:8.0f} req/s, p50 {p50:7.1f} ms, p99 {p99:7.1f} ms, errors {len(errors)}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare request throughput of the namenode servers')
+    parser.add_argument('--servers', nargs='+', default=['threaded', 'asyncio'], choices=['threaded', 'asyncio'])
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--concurrency', type=int, default=500, help='Number of clients sending requests at once')
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--pool_size', type=int, default=64, help='Connections kept by the namenode per datanode')
+    parser.add_argument('--datanode_delay', type=float, default=None,
+                        help='Register a fake datanode on 127.0.0.1:21 answering every command after this delay')
+    asyncio.run(benchmark(parser.parse_args()))
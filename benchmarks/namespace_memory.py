@@ -0,0 +1,39 @@
+import argparse
+import random
+import tracemalloc
+
+from namenode.fs_tree import Block, Directory
+
+
+def build_tree(num_files, files_per_dir, blocks_per_file, num_replicas, num_datanodes):
+    datanodes = [f'172.18.{i // 256}.{i % 256}' for i in range(num_datanodes)]
+    root = Directory('/')
+    directory = None
+    for i in range(num_files):
+        if i % files_per_dir == 0:
+            directory = root.add_directory(f'dir{i // files_per_dir}')
+        file = directory.add_file(f'file{i % files_per_dir}')
+        file.blocks = [Block(file, index, 64 * 1024 * 1024, random.sample(datanodes, num_replicas))
+                       for index in range(blocks_per_file)]
+        file.size = blocks_per_file * 64 * 1024 * 1024
+    return root
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure namenode memory needed per file system tree node')
+    parser.add_argument('--files', type=int, default=1000000)
+    parser.add_argument('--files_per_dir', type=int, default=100)
+    parser.add_argument('--blocks', type=int, default=1, help='Blocks per file')
+    parser.add_argument('--replicas', type=int, default=3)
+    parser.add_argument('--datanodes', type=int, default=20)
+    args = parser.parse_args()
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tree = build_tree(args.files, args.files_per_dir, args.blocks, args.replicas, args.datanodes)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    inodes = args.files + -(-args.files // args.files_per_dir) + 1
+    print(f'Files: {args.files}, directories: {inodes - args.files}, blocks: {args.files * args.blocks}')
+    print(f'Memory: {used / 1024 / 1024:.1f} MB, {used / inodes:.0f} bytes per inode')
@@ -0,0 +1,25 @@
+import argparse
+import timeit
+
+from namenode.fs_tree import Directory
+
+
+def deep_file(depth):
+    directory = Directory('/')
+    for level in range(depth):
+        directory = directory.add_directory(f'level{level}')
+    return directory.add_file('file')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure cost of file lookups in lock tables depending on tree depth')
+    parser.add_argument('--depths', type=int, nargs='+', default=[1, 10, 100, 500])
+    parser.add_argument('--number', type=int, default=100000)
+    args = parser.parse_args()
+
+    for depth in args.depths:
+        file = deep_file(depth)
+        locks = {file: 0}
+        lookup = timeit.timeit(lambda: locks[file], number=args.number) / args.number
+        path = timeit.timeit(lambda: str(file), number=args.number) / args.number
+        print(f'Depth {depth:4}: dict lookup {lookup * 1e9:7.0f} ns, path {path * 1e9:7.0f} ns')
@@ -1,33 +1,51 @@
 import os
+import posixpath
 import sys
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from ftplib import FTP, all_errors
-from threading import Thread, Event
+from threading import Thread, Event, local
 
 import requests
 from tcp_latency import measure_latency
 
 NAMENODE_ADDR = 'namenode'
+TRANSFER_THREADS = 4
+STRIPE_SIZE = 4 * 1024 * 1024
+# Bytes read from the socket or the file at once, set MEOWFS_BUFFER_SIZE to tune it for the network
+TRANSFER_BUFFER_SIZE = int(os.environ.get('MEOWFS_BUFFER_SIZE', 256 * 1024))
+TRANSFER_RETRIES = 3
+TRANSFER_FILES = 8
+BATCH_SIZE = 1000
+LS_PAGE_SIZE = 1000
+
+sessions = local()
 
 
 def print_help():
     print("""\nList of available commands:
     init
-    create <file name/path in FS>
+    create <file name/path in FS> [<file name/path in FS> ...]
     read   <file name/path in FS> <file name/path on Client>
     write  <file name/path on Client> <file name/path in FS>
     rm     <file name/path in FS>
-    info   <file name/path in FS>
+    info   [--verify] <file name/path in FS> [<file name/path in FS> ...]
     cp     <from file name/path in FS> <to file name/path in FS>
     mv     <from file name/path in FS> <to file name/path in FS>
+    put    <folder name/path on Client> <folder name/path in FS>
+    get    <folder name/path in FS> <folder name/path on Client>
     cd     <folder name/path in FS>
     ls     <folder name/path in FS>
-    mkdir  <folder name/path in FS>
+    mkdir  [-p] <folder name/path in FS>
     rmdir  <folder name/path in FS>\n""")
 
 
 def send_req(cmd, args='', show=True):
     try:
-        r = requests.get(f'http://{NAMENODE_ADDR}:80/' + cmd, json=args)
+        if not hasattr(sessions, 'namenode'):
+            sessions.namenode = requests.Session()
+        r = sessions.namenode.post(f'http://{NAMENODE_ADDR}:80/' + cmd, json=args)
         if show:
             print(r.json()['msg'])
         return r.json()['msg']
@@ -35,18 +53,165 @@ def send_req(cmd, args='', show=True):
         print(e)
 
 
+def send_batch(items, cmd='batch', key='operations'):
+    """Send items to the namenode BATCH_SIZE at a time, return their results or None on failure."""
+    results = []
+    for start in range(0, len(items), BATCH_SIZE):
+        answer = send_req(cmd, {key: items[start:start + BATCH_SIZE]}, show=False)
+        if not isinstance(answer, list):
+            if answer is not None:
+                print(answer)
+            return None
+        results.extend(answer)
+    return results
+
+
 def ping_datanodes(datanodes):
-    latency = []
+    latency = {}
     for datanode in datanodes:
-        latency.append(measure_latency(host=datanode, port=21)[0])
+        latency[datanode] = measure_latency(host=datanode, port=21, wait=0)[0]
     return latency
 
 
-def update_lock(event, file_from):
-    while not event.wait(300):
+def sort_by_latency(datanodes, latency):
+    return sorted(datanodes, key=lambda node: float('inf') if latency.get(node) is None else latency[node])
+
+
+def update_lock(event, file_from, period):
+    while not event.wait(period):
         send_req('update_lock', {'file_path': file_from}, show=False)
 
 
+def update_locks(event, file_paths, period):
+    while not event.wait(period):
+        send_batch([{'op': 'update_lock', 'file_path': file_path} for file_path in file_paths])
+
+
+def renew_lock(file_path):
+    return send_req('update_lock', {'file_path': file_path}, show=False) == ''
+
+
+def resume_point(datanode, path, length):
+    with FTP(datanode) as ftp:
+        ftp.login()
+        ftp.voidcmd('TYPE I')
+        return min(ftp.size(path), length)
+
+
+def plan_stripes(blocks, latency):
+    """Split blocks into byte ranges which are downloaded from different replicas at the same time."""
+    stripes = []
+    offset = 0
+    for block in blocks:
+        datanodes = sort_by_latency(block['ips'], latency)
+        count = max(1, min(len(datanodes), block['size'] // STRIPE_SIZE))
+        stripe_size = -(-block['size'] // count)
+        for i, start in enumerate(range(0, block['size'], stripe_size)):
+            length = min(stripe_size, block['size'] - start)
+            stripes.append((block['path'], start, offset + start, length, datanodes[i:] + datanodes[:i]))
+        offset += block['size']
+    return stripes
+
+
+def local_checksum(fd, offset, size):
+    checksum = 0
+    for start in range(offset, offset + size, TRANSFER_BUFFER_SIZE):
+        checksum = zlib.crc32(os.pread(fd, min(TRANSFER_BUFFER_SIZE, offset + size - start), start), checksum)
+    return checksum
+
+
+def stored_checksum(ftp, path):
+    try:
+        return int(ftp.sendcmd('CKSM ' + path).split()[-1], 16)
+    except all_errors:
+        return None
+
+
+def verify_blocks(blocks, localfile, file_path):
+    """Check downloaded blocks against their checksums, a mismatching block is downloaded again from its replicas.
+
+    Replicas which arrive whole but do not match are reported to namenode once a matching one is found.
+    """
+    offset = 0
+    for block in blocks:
+        if block['checksum'] is not None and \
+                local_checksum(localfile.fileno(), offset, block['size']) != block['checksum']:
+            corrupted = []
+            for node in block['ips']:
+                if not download_stripe(block['path'], 0, offset, block['size'], [node], localfile, file_path):
+                    continue
+                if local_checksum(localfile.fileno(), offset, block['size']) == block['checksum']:
+                    break
+                corrupted.append(node)
+            else:
+                return False
+            for node in corrupted:
+                send_req('drop_replicas', {'datanode_ip': node, 'block_paths': [block['path']]}, show=False)
+        offset += block['size']
+    return True
+
+
+def download_stripe(path, start, position, length, datanodes, localfile, file_path):
+    received = 0
+    for attempt, datanode in enumerate(node for node in datanodes for _ in range(TRANSFER_RETRIES)):
+        if attempt > 0 and not renew_lock(file_path):
+            return False
+        ftp = FTP()
+        try:
+            ftp.connect(datanode)
+            ftp.login()
+            ftp.voidcmd('TYPE I')
+            with ftp.transfercmd('RETR ' + path, start + received or None) as conn:
+                while received < length:
+                    data = conn.recv(min(TRANSFER_BUFFER_SIZE, length - received))
+                    if not data:
+                        break
+                    os.pwrite(localfile.fileno(), data, position + received)
+                    received += len(data)
+            if received == length:
+                return True
+        except all_errors:
+            continue
+        finally:
+            ftp.close()
+    return False
+
+
+def upload_block(block, offset, datanodes, file_from, file_path):
+    with open(file_from, 'rb') as localfile:
+        checksum = local_checksum(localfile.fileno(), offset, block['size'])
+    for datanode in datanodes:
+        chain = [node for node in block['ips'] if node != datanode]
+        started = False
+        for attempt in range(TRANSFER_RETRIES):
+            try:
+                sent = 0
+                if attempt > 0:
+                    if not renew_lock(file_path):
+                        return None
+                    if started:
+                        sent = resume_point(datanode, block['path'], block['size'])
+                with FTP(datanode) as ftp, open(file_from, 'rb') as localfile:
+                    ftp.login()
+                    if chain:
+                        ftp.voidcmd('CHAIN ' + ' '.join(chain))
+                    ftp.voidcmd('TYPE I')
+                    with ftp.transfercmd('STOR ' + block['path'], sent or None) as conn:
+                        started = True
+                        conn.sendfile(localfile, offset + sent, block['size'] - sent)
+                    ftp.voidresp()
+                    if stored_checksum(ftp, block['path']) != checksum:
+                        started = False
+                        continue
+                    replicas = []
+                    if chain:
+                        replicas = ftp.sendcmd('CHAINSTAT').split(': ', 1)[1].split()
+                return {'node_ip': datanode, 'replicas': replicas, 'checksum': checksum}
+            except all_errors:
+                continue
+    return None
+
+
 def read_file(file_from, file_to=None):
     if file_to is None:
         file_to = file_from
@@ -54,31 +219,25 @@ def read_file(file_from, file_to=None):
     if isinstance(result, str):
         print(result)
         return
-    datanodes = result['ips']
+    blocks = result['blocks']
     file_from = result['path']
 
     event = Event()
-    send_clock_update = Thread(target=update_lock, args=(event, file_from))
+    send_clock_update = Thread(target=update_lock, args=(event, file_from, result['lock_duration'] / 3))
     send_clock_update.start()
 
-    latency = ping_datanodes(datanodes)
-    data_stored = False
-    for latency, datanode in sorted(zip(latency, datanodes)):
-        try:
-            with FTP(datanode) as ftp, open(file_to, 'wb') as localfile:
-                ftp.login()
-                ftp.retrbinary('RETR ' + file_from, localfile.write, 1024)
-                data_stored = True
-                break
-        except PermissionError:
-            print("Cannot open file. Try with sudo")
-            data_stored = True
-            break
-        except all_errors:
-            continue
-
-    if not data_stored:
-        print('Cannot connect to datanode')
+    latency = ping_datanodes({node for block in blocks for node in block['ips']})
+    try:
+        with open(file_to, 'w+b') as localfile, ThreadPoolExecutor(TRANSFER_THREADS) as executor:
+            localfile.truncate(result['size'])
+            futures = [executor.submit(download_stripe, *stripe, localfile, file_from)
+                       for stripe in plan_stripes(blocks, latency)]
+            if not all(future.result() for future in futures):
+                print('Cannot connect to datanode')
+            elif not verify_blocks(blocks, localfile, file_from):
+                print('File is corrupted on all datanodes')
+    except PermissionError:
+        print("Cannot open file. Try with sudo")
 
     event.set()
     send_clock_update.join()
@@ -96,33 +255,28 @@ def write_file(file_from, file_to=None):
         print(result)
         return
 
-    datanodes = result['ips']
+    blocks = result['blocks']
     file_to = result['path']
 
     event = Event()
-    send_clock_update = Thread(target=update_lock, args=(event, file_to))
+    send_clock_update = Thread(target=update_lock, args=(event, file_to, result['lock_duration'] / 3))
     send_clock_update.start()
 
-    latencies = ping_datanodes(datanodes)
-
-    connected_node = None
-    for latency, datanode in sorted(zip(latencies, datanodes)):
-        try:
-            with FTP(datanode) as ftp, open(file_from, 'rb') as localfile:
-                ftp.login()
-                ftp.storbinary('STOR ' + file_to, localfile)
-                connected_node = datanode
-            break
-        except all_errors:
-            continue
+    latency = ping_datanodes({node for block in blocks for node in block['ips']})
+    offsets = [i * result['block_size'] for i in range(len(blocks))]
+    with ThreadPoolExecutor(TRANSFER_THREADS) as executor:
+        futures = [executor.submit(upload_block, block, offset, sort_by_latency(block['ips'], latency), file_from,
+                                   file_to)
+                   for block, offset in zip(blocks, offsets)]
+        reports = [future.result() for future in futures]
 
-    if connected_node is None:
+    if None in reports:
         print('Cannot connect to datanode')
         send_req('release_lock', {'file_path': file_to}, show=False)
     else:
         t = Thread(target=send_req,
                    args=('replicate_file',
-                         {'file_path': file_to, 'node_ip': connected_node},
+                         {'file_path': file_to, 'blocks': reports},
                          False))
         t.start()
 
@@ -130,6 +284,37 @@ def write_file(file_from, file_to=None):
     send_clock_update.join()
 
 
+def print_stats(file_paths):
+    results = send_batch(file_paths, 'stat', 'file_paths')
+    for file_path, stat in zip(file_paths, results or []):
+        if isinstance(stat, str):
+            print(f'{file_path}: {stat}')
+            continue
+        modified = '' if stat['mtime'] is None else time.strftime(', modified %Y-%m-%d %H:%M:%S',
+                                                                   time.gmtime(stat['mtime']))
+        print(f"{stat['path']}: {stat['size']} B{modified}, {len(stat['checksums'])} blocks on "
+              f"{', '.join(stat['nodes']) or 'no datanodes'}")
+
+
+def list_directory(dir_path=None):
+    """Print the directory page by page as the pages arrive, subdirectories end with a slash."""
+    args = {'limit': LS_PAGE_SIZE}
+    if dir_path is not None:
+        args['dir_path'] = dir_path
+    while True:
+        page = send_req('ls', args, show=False)
+        if not isinstance(page, dict):
+            if page is not None:
+                print(page)
+            return
+        names = sorted(page['files'] + [name + '/' for name in page['dirs']], key=lambda name: name.rstrip('/'))
+        if names:
+            print('\n'.join(names), flush=True)
+        if page['next'] is None:
+            return
+        args['start_after'] = page['next']
+
+
 def delete_directory(dir_path):
     response, flag = send_req('rmdir', {'dir_path': dir_path}, show=False)
 
@@ -141,17 +326,181 @@ def delete_directory(dir_path):
         print(response)
 
 
+def create_files(file_paths):
+    results = send_batch([{'op': 'create', 'file_path': file_path} for file_path in file_paths])
+    for file_path, result in zip(file_paths, results or []):
+        if result:
+            print(f'{file_path}: {result}')
+
+
+def create_directories(dir_paths):
+    results = send_batch([{'op': 'mkdir', 'dir_path': dir_path} for dir_path in dir_paths])
+    if results is None:
+        return False
+    errors = [f'{dir_path}: {result}' for dir_path, result in zip(dir_paths, results)
+              if result and result != 'Directory already exist.']
+    for error in errors:
+        print(error)
+    return not errors
+
+
+def make_directories(dir_path):
+    components = [component for component in dir_path.split('/') if component]
+    prefix = '/' if dir_path.startswith('/') else ''
+    create_directories([prefix + '/'.join(components[:i + 1]) for i in range(len(components))])
+
+
+def upload_file(file_from, result, latency):
+    reports = []
+    for i, block in enumerate(result['blocks']):
+        report = upload_block(block, i * result['block_size'], sort_by_latency(block['ips'], latency), file_from,
+                              result['path'])
+        if report is None:
+            return None
+        reports.append(report)
+    return reports
+
+
+def download_file(file_to, result, latency):
+    try:
+        with open(file_to, 'w+b') as localfile:
+            localfile.truncate(result['size'])
+            return all(download_stripe(*stripe, localfile, result['path'])
+                       for stripe in plan_stripes(result['blocks'], latency)) and \
+                verify_blocks(result['blocks'], localfile, result['path'])
+    except OSError as e:
+        print(e)
+        return False
+
+
+def transfer_files(transfer, files):
+    """Run transfer(local path, namenode answer, latency) for every file, TRANSFER_FILES files at once.
+
+    Locks of all the files are renewed with one batch request per period until every transfer is over.
+    """
+    if not files:
+        return []
+    latency = ping_datanodes({node for _, result in files for block in result['blocks'] for node in block['ips']})
+    event = Event()
+    send_clock_update = Thread(target=update_locks, args=(event, [result['path'] for _, result in files],
+                                                          files[0][1]['lock_duration'] / 3))
+    send_clock_update.start()
+    try:
+        with ThreadPoolExecutor(TRANSFER_FILES) as executor:
+            futures = [executor.submit(transfer, local_path, result, latency) for local_path, result in files]
+            return [future.result() for future in futures]
+    finally:
+        event.set()
+        send_clock_update.join()
+
+
+def print_throughput(action, sizes, elapsed):
+    size = sum(sizes) / 1000000
+    print(f'{action} {len(sizes)} files, {size:.1f} MB in {elapsed:.2f} s ({size / elapsed:.1f} MB/s)')
+
+
+def put_directory(dir_from, dir_to):
+    start = time.perf_counter()
+    dir_paths = []
+    file_paths = []
+    for root, _, names in os.walk(dir_from):
+        relative = os.path.relpath(root, dir_from)
+        remote = dir_to if relative == '.' else posixpath.join(dir_to, *relative.split(os.sep))
+        dir_paths.append(remote)
+        file_paths.extend((os.path.join(root, name), posixpath.join(remote, name)) for name in names)
+    if not dir_paths:
+        print('Directory does not exist.')
+        return
+    if not create_directories(dir_paths):
+        return
+
+    results = send_batch([{'op': 'write', 'file_path': remote, 'file_size': os.path.getsize(local)}
+                          for local, remote in file_paths])
+    if results is None:
+        return
+    files = []
+    for (local, remote), result in zip(file_paths, results):
+        if isinstance(result, str):
+            print(f'{remote}: {result}')
+        else:
+            files.append((local, result))
+
+    reports = transfer_files(upload_file, files)
+    operations = []
+    sizes = []
+    for (local, result), report in zip(files, reports):
+        if report is None:
+            print(f"{result['path']}: Cannot connect to datanode")
+            operations.append({'op': 'release_lock', 'file_path': result['path']})
+        else:
+            operations.append({'op': 'replicate', 'file_path': result['path'], 'blocks': report})
+            sizes.append(os.path.getsize(local))
+    send_batch(operations)
+    print_throughput('Uploaded', sizes, time.perf_counter() - start)
+
+
+def get_directory(dir_from, dir_to):
+    start = time.perf_counter()
+    file_paths = []
+    level = [(dir_from, dir_to)]
+    while level:
+        results = send_batch([{'op': 'ls', 'dir_path': remote} for remote, _ in level])
+        if results is None:
+            return
+        next_level = []
+        for (remote, local), result in zip(level, results):
+            if isinstance(result, str):
+                print(f'{remote}: {result}')
+                continue
+            try:
+                os.makedirs(local, exist_ok=True)
+            except OSError as e:
+                print(e)
+                continue
+            file_paths.extend((posixpath.join(remote, name), os.path.join(local, name)) for name in result['files'])
+            next_level.extend((posixpath.join(remote, name), os.path.join(local, name)) for name in result['dirs'])
+        level = next_level
+
+    results = send_batch([{'op': 'read', 'file_path': remote} for remote, _ in file_paths])
+    if results is None:
+        return
+    files = []
+    for (remote, local), result in zip(file_paths, results):
+        if isinstance(result, str):
+            print(f'{remote}: {result}')
+        else:
+            files.append((local, result))
+
+    downloaded = transfer_files(download_file, files)
+    send_batch([{'op': 'release_lock', 'file_path': result['path']} for _, result in files])
+    sizes = []
+    for (local, result), ok in zip(files, downloaded):
+        if ok:
+            sizes.append(result['size'])
+        else:
+            print(f"{result['path']}: Cannot download file")
+    print_throughput('Downloaded', sizes, time.perf_counter() - start)
+
+
 def main():
     args = sys.argv[1:]  # get command with arguments
     if len(args) == 0:
         print("Empty command!\nFor help write command: help")
+    elif args[0] == 'create' and len(args) > 2:
+        create_files(args[1:])
+    elif args[:2] == ['mkdir', '-p'] and len(args) == 3:
+        make_directories(args[2])
+    elif args[:2] == ['info', '--verify'] and len(args) == 3:
+        send_req('info', {'file_path': args[2], 'verify': True})
+    elif args[0] == 'info' and len(args) > 2:
+        print_stats(args[1:])
     elif len(args) == 1:  # commands without any argument
         if args[0] == 'help':
             print_help()
         elif args[0] == 'init':
             send_req('init')
         elif args[0] == 'ls':
-            send_req('ls', {})
+            list_directory()
         else:
             print("Incorrect command!\nFor help write command: help")
     elif len(args) == 2:  # commands with 1 argument
@@ -164,7 +513,7 @@ def main():
         elif args[0] == 'cd':
             send_req('cd', {'dir_path': args[1]})
         elif args[0] == 'ls':
-            send_req('ls', {'dir_path': args[1]})
+            list_directory(args[1])
         elif args[0] == 'mkdir':
             send_req('mkdir', {'dir_path': args[1]})
         elif args[0] == 'rmdir':
@@ -184,6 +533,10 @@ def main():
             send_req('copy', {'file_path_from': args[1], 'dir_path_to': args[2]})
         elif args[0] == 'mv':
             send_req('move', {'file_path_from': args[1], 'dir_path_to': args[2]})
+        elif args[0] == 'put':
+            put_directory(args[1], args[2])
+        elif args[0] == 'get':
+            get_directory(args[1], args[2])
         else:
             print("Incorrect command!\nFor help write command: help")
     else:
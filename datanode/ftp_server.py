@@ -1,15 +1,24 @@
 import argparse
+import hashlib
+import json
 import os
+import posixpath
 import shutil
+import signal
 import subprocess
+import sys
+import time
+import zlib
 from ftplib import FTP, all_errors
 from os.path import join, isdir, isfile, exists, abspath
+from threading import Lock, Thread
 
 import requests
 from pyftpdlib.authorizers import DummyAuthorizer
-from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.filesystems import AbstractedFS
+from pyftpdlib.handlers import DTPHandler, FTPHandler
 from pyftpdlib.log import logger
-from pyftpdlib.servers import FTPServer
+from pyftpdlib.servers import ThreadedFTPServer
 
 proto_cmds = FTPHandler.proto_cmds.copy()
 proto_cmds.update(
@@ -28,19 +37,227 @@ proto_cmds.update(
      'CP': dict(perm='w', auth=True, arg=True,
                 help='Syntax: CP path_from path_to (copy file from path_from to path_to).'),
      'REPL': dict(perm='w', auth=True, arg=True,
-                  help='Syntax: REPL ip_datanode path_from path_to (make replica on ip_datanode).')
+                  help='Syntax: REPL path_from path_to ip_datanode [ip_datanode ...] '
+                       '(make replicas on the chain of datanodes).'),
+     'CHAIN': dict(perm=None, auth=True, arg=True,
+                   help='Syntax: CHAIN ip_datanode [ip_datanode ...] '
+                        '(forward the next uploaded file to the chain of datanodes).'),
+     'CHAINSTAT': dict(perm=None, auth=True, arg=False,
+                       help='Syntax: CHAINSTAT (return datanodes which stored the last forwarded file).'),
+     'CKSM': dict(perm='r', auth=True, arg=True,
+                  help='Syntax: CKSM path (return CRC32 of the file computed when it was stored).')
      }
 )
 
+CHECKSUM_SUFFIX = '.crc'
+# Seconds a datanode waits on the next datanode of a chain before giving the replica up
+CHAIN_TIMEOUT = 60
+CHECKSUM_BUFFER_SIZE = 1024 * 1024
+DIGESTS_SUFFIX = '.digests'
+
+
+def read_checksum(path):
+    try:
+        with open(path + CHECKSUM_SUFFIX) as file:
+            return int(file.read(), 16)
+    except (OSError, ValueError):
+        return None
+
+
+def write_checksum(path, checksum):
+    with open(path + CHECKSUM_SUFFIX, 'w') as file:
+        file.write(f'{checksum:08x}')
+
+
+def remove_checksum(path):
+    try:
+        os.remove(path + CHECKSUM_SUFFIX)
+    except OSError:
+        pass
+
+
+def remove_block(path):
+    os.remove(path)
+    remove_checksum(path)
+
+
+def file_checksum(fd, length=None, rate=None):
+    """CRC32 of the first length bytes of the file, of all of it if length is None.
+
+    With a rate in bytes per second the reading is slowed down to it, and pages which were read are
+    dropped from the page cache so that a background pass does not push out data of foreground I/O.
+    """
+    checksum = 0
+    offset = 0
+    while length is None or offset < length:
+        size = CHECKSUM_BUFFER_SIZE if length is None else min(CHECKSUM_BUFFER_SIZE, length - offset)
+        data = os.pread(fd, size, offset)
+        if not data:
+            break
+        checksum = zlib.crc32(data, checksum)
+        if rate:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fd, offset, len(data), os.POSIX_FADV_DONTNEED)
+            time.sleep(len(data) / rate)
+        offset += len(data)
+    return checksum
+
+
+def remote_checksum(ftp, path):
+    try:
+        return int(ftp.sendcmd('CKSM ' + path).split()[-1], 16)
+    except all_errors:
+        return None
+
+
+def chain_replicas(ftp):
+    return ftp.sendcmd('CHAINSTAT').split(': ', 1)[1].split()
+
+
+class ChecksumWriter:
+    """File object which computes CRC32 of the file while it is received and stores it next to the file."""
+
+    def __init__(self, file):
+        self.file = file
+        self.checksum = None
+
+    def __getattr__(self, item):
+        return getattr(self.file, item)
+
+    def write(self, data):
+        if self.checksum is None:
+            # a resumed upload starts in the middle of the file
+            with open(self.file.name, 'rb') as file:
+                self.checksum = file_checksum(file.fileno(), self.file.tell())
+        self.file.write(data)
+        self.checksum = zlib.crc32(data, self.checksum)
+
+    def close(self):
+        self.file.close()
+        if self.checksum is None:
+            with open(self.file.name, 'rb') as file:
+                self.checksum = file_checksum(file.fileno())
+        write_checksum(self.file.name, self.checksum)
+
+
+class ChainWriter(ChecksumWriter):
+    """File object which forwards everything written to it to the next datanode of the chain."""
+
+    def __init__(self, file, path, handler, chain):
+        super().__init__(file)
+        self.path = path
+        self.handler = handler
+        self.chain = chain
+        self.ftp = None
+        self.conn = None
+        self.failed = False
+
+    def _connect(self, offset):
+        self.ftp = FTP(self.chain[0], timeout=CHAIN_TIMEOUT, **self.handler.auth_data)
+        if not self.handler.auth_data:
+            self.ftp.login()
+        if len(self.chain) > 1:
+            self.ftp.voidcmd('CHAIN ' + ' '.join(self.chain[1:]))
+        self.ftp.voidcmd('TYPE I')
+        self.conn = self.ftp.transfercmd('STOR ' + self.path, offset or None)
+
+    def _disconnect(self):
+        for obj in (self.conn, self.ftp):
+            try:
+                if obj is not None:
+                    obj.close()
+            except all_errors:
+                pass
+
+    def write(self, data):
+        super().write(data)
+        if self.failed:
+            return
+        try:
+            if self.conn is None:
+                self._connect(self.file.tell() - len(data))
+            self.conn.sendall(data)
+        except all_errors:
+            self.failed = True
+            self._disconnect()
+
+    def close(self):
+        super().close()
+        self.handler.chain_replicas = []
+        if self.failed:
+            return
+        try:
+            if self.conn is None:
+                self._connect(0)
+            self.conn.close()
+            self.ftp.voidresp()
+            if remote_checksum(self.ftp, self.path) == self.checksum:
+                self.handler.chain_replicas = [self.chain[0]] + chain_replicas(self.ftp)
+            self.ftp.quit()
+        except all_errors:
+            self._disconnect()
+
+
+class ChainedFS(AbstractedFS):
+    def open(self, filename, mode):
+        if mode != 'rb':
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        file = super().open(filename, mode)
+        if mode == 'rb':
+            return file
+        self.cmd_channel.storage.forget(self.fs2ftp(os.path.dirname(filename)))
+        if not self.cmd_channel.chain:
+            return ChecksumWriter(file)
+        chain, self.cmd_channel.chain = self.cmd_channel.chain, []
+        return ChainWriter(file, self.fs2ftp(filename), self.cmd_channel, chain)
+
+
+class CustomizedDTPHandler(DTPHandler):
+    ac_in_buffer_size = 256 * 1024
+    ac_out_buffer_size = 256 * 1024
+
 
 class CustomizedFTPHandler(FTPHandler):
     proto_cmds = proto_cmds
+    abstracted_fs = ChainedFS
+    dtp_handler = CustomizedDTPHandler
     homedir = ''
     auth_data = {}
+    chain = []
+    chain_replicas = []
+    storage = None
+
+    def forget(self, path):
+        self.storage.forget(self.fs.fs2ftp(path))
+
+    def ftp_MKD(self, path):
+        result = super().ftp_MKD(path)
+        self.forget(path)
+        return result
+
+    def ftp_RMD(self, path):
+        result = super().ftp_RMD(path)
+        self.forget(path)
+        return result
+
+    def ftp_RNTO(self, path):
+        path_from = self._rnfr
+        result = super().ftp_RNTO(path)
+        if path_from is not None:
+            self.forget(path_from)
+        self.forget(path)
+        return result
+
+    def ftp_DELE(self, path):
+        if super().ftp_DELE(path) is not None:
+            remove_checksum(path)
+            self.forget(path)
+            return path
 
     def ftp_RMTREE(self, line):
         if isdir(line):
             shutil.rmtree(line)
+            self.forget(line)
             self.respond("250 RMTREE Directory tree was deleted successfully", logfun=logger.info)
         else:
             self.respond(f"550 RMTREE {line} is not a directory", logfun=logger.info)
@@ -53,6 +270,7 @@ class CustomizedFTPHandler(FTPHandler):
                     shutil.rmtree(obj)
                 elif isfile(obj):
                     os.remove(obj)
+            self.forget(line)
             self.respond(f"250 RMDCONT Content of {line} was deleted successfully", logfun=logger.info)
         else:
             self.respond(f"550 RMDCONT {line} is not a directory", logfun=logger.info)
@@ -68,6 +286,8 @@ class CustomizedFTPHandler(FTPHandler):
     def ftp_SITE_EXEC(self, line):
         process = subprocess.run(line, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
 
+        # the command may have changed anything in the storage
+        self.storage.forget('/')
         if process.returncode != 0:
             error = process.stderr.decode("utf-8")
             self.respond(f"500 SITE EXEC {line} failed with {error}", logfun=logger.info)
@@ -78,66 +298,271 @@ class CustomizedFTPHandler(FTPHandler):
 
     def ftp_CRF(self, path):
         open(path, 'wb').close()
+        self.forget(path)
         self.respond(f"250 CRF {path} was created successfully", logfun=logger.info)
 
     def ftp_MV(self, line):
         path_from, path_to = line.split(' ')
         path_to = self.homedir + path_to
         dest = shutil.move(path_from, path_to)
+        self.forget(path_from)
+        self.forget(dest)
         self.respond(f"250 MV {path_from} was copied to {dest} successfully", logfun=logger.info)
 
     def ftp_CP(self, line):
         path_from, path_to = line.split(' ')
         path_to = self.homedir + path_to
-        dest = shutil.copyfile(path_from, path_to)
+        if isdir(path_from):
+            dest = shutil.copytree(path_from, path_to)
+        else:
+            dest = shutil.copyfile(path_from, path_to)
+        self.forget(dest)
         self.respond(f"250 CP {path_from} was copied to {dest} successfully", logfun=logger.info)
 
     def ftp_REPL(self, line):
-        path_from, path_to, ip_datanode = line.split(' ')
+        path_from, path_to, checksum, *chain = line.split(' ')
+        checksum = None if checksum == '-' else int(checksum, 16)
         try:
-            with FTP(ip_datanode, **self.auth_data) as ftp, open(path_from, 'rb') as localfile:
+            with FTP(chain[0], timeout=CHAIN_TIMEOUT, **self.auth_data) as ftp, open(path_from, 'rb') as localfile:
+                if checksum is not None and file_checksum(localfile.fileno()) != checksum:
+                    self.respond(f"550 REPL {path_from} does not match its checksum", logfun=logger.info)
+                    return False
                 if not self.auth_data:
                     ftp.login()
-                ftp.storbinary('STOR ' + path_to, localfile)
+                if len(chain) > 1:
+                    ftp.voidcmd('CHAIN ' + ' '.join(chain[1:]))
+                ftp.voidcmd('TYPE I')
+                with ftp.transfercmd('STOR ' + path_to) as conn:
+                    conn.sendfile(localfile)
+                ftp.voidresp()
+                if checksum is not None and remote_checksum(ftp, path_to) != checksum:
+                    self.respond(f"550 REPL Replica on {chain[0]} does not match the checksum", logfun=logger.info)
+                    return False
+                replicas = [chain[0]] + chain_replicas(ftp)
         except all_errors:
-            self.respond(f"500 REPL Replica was not created on {ip_datanode} due to connection error",
+            self.respond(f"500 REPL Replica was not created on {chain[0]} due to connection error",
                          logfun=logger.info)
             return False
 
-        self.respond(f"250 REPL Replica was created on {ip_datanode}", logfun=logger.info)
+        self.respond(f"250 REPL Replicas were created on: {' '.join(replicas)}", logfun=logger.info)
         return True
 
+    def ftp_CHAIN(self, line):
+        self.chain = line.split(' ')
+        self.chain_replicas = []
+        self.respond(f"200 CHAIN Next uploaded file will be forwarded to {line}", logfun=logger.info)
+
+    def ftp_CHAINSTAT(self, line):
+        self.respond(f"200 CHAINSTAT Replicas were created on: {' '.join(self.chain_replicas)}",
+                     logfun=logger.info)
+
+    def ftp_CKSM(self, path):
+        checksum = read_checksum(path)
+        if checksum is None:
+            self.respond(f"550 CKSM {path} has no checksum", logfun=logger.info)
+        else:
+            self.respond(f"213 CKSM {checksum:08x}", logfun=logger.info)
+
+
+def scrub(namenode_ip, homedir, storage, rate, interval):
+    """Re-read stored blocks at a limited rate, delete the ones not matching their checksums and report them."""
+    session = requests.Session()
+    while True:
+        for path, dirs, files in os.walk(homedir):
+            for name in files:
+                if not name.endswith(CHECKSUM_SUFFIX):
+                    continue
+                block = join(path, name[:-len(CHECKSUM_SUFFIX)])
+                try:
+                    modified = os.stat(block).st_mtime_ns
+                    with open(block, 'rb') as file:
+                        checksum = file_checksum(file.fileno(), rate=rate)
+                    if checksum == read_checksum(block) or os.stat(block).st_mtime_ns != modified:
+                        continue
+                    remove_block(block)
+                    block_path = '/' + os.path.relpath(block, homedir)
+                    storage.forget(block_path)
+                    session.post(f'http://{namenode_ip}:80/drop_replicas', json={'block_paths': [block_path]})
+                except Exception as e:
+                    print(e)
+        time.sleep(interval)
+
+
+def entries_digest(dirs, files):
+    """Digest of a directory, computed the same way as in namenode/digest.py."""
+    entries = sorted([f'd/{name}/{digest}' for name, digest in dirs.items()] +
+                     [f"f/{name}/{','.join(map(str, sorted(indices)))}" for name, indices in files.items()])
+    return hashlib.blake2b('\0'.join(entries).encode(), digest_size=16).hexdigest()
+
 
-def connect_to_namenode(namenode_ip, homedir):
-    cur_dir = os.getcwd()
+class StorageDigests:
+    """Digests of the stored directories, kept between comparisons with the namespace and across restarts.
+
+    Every stored directory has an entry {'digest', 'blocks', 'children': {name: entry}}. A directory holding
+    block files is a file of the namespace and has the sorted indices of its blocks instead of a digest.
+    Entries are read from the disk when they are asked for, and every change of the storage forgets the
+    entry of the changed path and the digests of the directories above it, so only the changed part of the
+    storage is read again.
+
+    The entries are saved when the server stops and the file is removed as soon as it is loaded, so the
+    whole storage is read again after a crash.
+    """
+
+    def __init__(self, homedir, path):
+        self.homedir = homedir
+        self.path = path
+        self.lock = Lock()
+        self.saved = False
+        self.root = self._load()
+
+    @staticmethod
+    def _entry(digest=None, blocks=None, children=None):
+        return {'digest': digest, 'blocks': blocks, 'children': children or {}}
+
+    def _load(self):
+        try:
+            with open(self.path) as file:
+                root = json.load(file)
+            os.remove(self.path)
+            return root
+        except (OSError, ValueError):
+            return self._entry()
+
+    def save(self):
+        """Digest the changed part of the storage and write all the entries to the file."""
+        with self.lock:
+            self.root = self._refresh(self.homedir, self.root)
+            with open(self.path + '.tmp', 'w') as file:
+                json.dump(self.root, file)
+            os.replace(self.path + '.tmp', self.path)
+            self.saved = True
+
+    def forget(self, path):
+        """Forget what is stored under path in FS and the digests of the directories above it."""
+        names = [name for name in path.split('/') if name and name != '.']
+        with self.lock:
+            if self.saved:
+                # the storage changed after the entries were saved
+                os.remove(self.path)
+                self.saved = False
+            parent, entry = None, self.root
+            for name in names:
+                entry['digest'] = entry['blocks'] = None
+                parent, entry = entry, entry['children'].get(name)
+                if entry is None:
+                    return
+            if parent is None:
+                self.root = self._entry()
+            else:
+                del parent['children'][names[-1]]
+
+    def _refresh(self, local_path, entry):
+        if entry['digest'] is not None or entry['blocks'] is not None:
+            return entry
+        subdirs, indices = [], []
+        for item in os.scandir(local_path):
+            if item.is_dir(follow_symlinks=False):
+                subdirs.append(item)
+            elif item.name.isdigit():
+                indices.append(int(item.name))
+        if indices:
+            return self._entry(blocks=sorted(indices))
+        children = {item.name: self._refresh(item.path, entry['children'].get(item.name) or self._entry())
+                    for item in subdirs}
+        dirs = {name: child['digest'] for name, child in children.items() if child['blocks'] is None}
+        files = {name: child['blocks'] for name, child in children.items() if child['blocks'] is not None}
+        return self._entry(entries_digest(dirs, files), None, children)
+
+    def _get(self, path):
+        names = [name for name in path.split('/') if name]
+        with self.lock:
+            parent, entry, local_path = None, self.root, self.homedir
+            for name in names:
+                local_path = join(local_path, name)
+                parent, entry = entry, entry['children'].get(name)
+                if entry is None:
+                    if not isdir(local_path):
+                        return None
+                    entry = parent['children'][name] = self._entry()
+            entry = self._refresh(local_path, entry)
+            if parent is None:
+                self.root = entry
+            else:
+                parent['children'][names[-1]] = entry
+            return entry
+
+    def digest(self, path):
+        """Digest of the stored directory of FS, None if there is no such directory."""
+        entry = self._get(path)
+        return None if entry is None else entry['digest']
+
+    def blocks(self, path):
+        """Indices of the stored blocks of the file of FS."""
+        entry = self._get(path)
+        return set() if entry is None or entry['blocks'] is None else set(entry['blocks'])
+
+
+def connect_to_namenode(namenode_ip, homedir, storage):
+    """Bring the storage in line with the namespace, descending only into directories whose digests differ."""
+    session = requests.Session()
     try:
-        r = requests.get(f'http://{namenode_ip}:80/synchronize', json='')
-        fs_tree = r.json()['msg']
-        os.chdir(homedir)
-        for path, dirs, files in os.walk(os.path.curdir):
-            cur_tree = fs_tree
-            components = path.split(os.sep)[1:]
-            for c in components:
-                cur_tree = cur_tree['d'][c]
-
-            for local_dir in dirs:
-                if local_dir not in cur_tree['d']:
-                    shutil.rmtree(join(path, local_dir))
-
-            for remote_dir in cur_tree['d']:
-                remote_dir = join(path, remote_dir)
-                if not exists(remote_dir):
-                    os.mkdir(remote_dir)
-
-            for local_file in files:
-                if local_file not in cur_tree['f']:
-                    os.remove(join(path, local_file))
-
-        requests.get(f'http://{namenode_ip}:80/add_node', json='')
+        pending = {'/': storage.digest('/')}
+        missing = []
+        while pending:
+            r = session.post(f'http://{namenode_ip}:80/compare_digests', json={'digests': pending})
+            pending = {}
+            for path, expected in r.json()['msg'].items():
+                local_dir = join(homedir, path.lstrip('/'))
+                if expected is None:
+                    shutil.rmtree(local_dir, ignore_errors=True)
+                    storage.forget(path)
+                    continue
+                for entry in os.scandir(local_dir):
+                    child = posixpath.join(path, entry.name)
+                    if not entry.is_dir(follow_symlinks=False):
+                        os.remove(entry.path)
+                        storage.forget(child)
+                    elif entry.name in expected['f']:
+                        stored = storage.blocks(child)
+                        for index in stored.difference(expected['f'][entry.name]):
+                            remove_block(join(entry.path, str(index)))
+                            storage.forget(child)
+                        missing.extend(f'{child}/{index}' for index in set(expected['f'][entry.name]) - stored)
+                    elif entry.name in expected['d']:
+                        digest = storage.digest(child)
+                        if digest != expected['d'][entry.name]:
+                            pending[child] = digest or ''
+                    else:
+                        shutil.rmtree(entry.path)
+                        storage.forget(child)
+                for name in expected['d']:
+                    if not exists(join(local_dir, name)):
+                        os.mkdir(join(local_dir, name))
+                        storage.forget(posixpath.join(path, name))
+                        pending[posixpath.join(path, name)] = entries_digest({}, {})
+                for name, indices in expected['f'].items():
+                    if not exists(join(local_dir, name)):
+                        missing.extend(f'{posixpath.join(path, name)}/{index}' for index in indices)
+
+        if missing:
+            session.post(f'http://{namenode_ip}:80/drop_replicas', json={'block_paths': missing})
+        session.post(f'http://{namenode_ip}:80/add_node', json={})
     except Exception as e:
         print(e)
-    finally:
-        os.chdir(cur_dir)
+
+
+def send_heartbeats(namenode_ip, homedir, storage, interval):
+    session = requests.Session()
+    while True:
+        try:
+            free = shutil.disk_usage(homedir).free
+            r = session.post(f'http://{namenode_ip}:80/heartbeat', json={'free': free})
+            if r.json()['msg'] == 'register':
+                # a node declared dead has lost its replicas in the namespace, so it resyncs before rejoining
+                connect_to_namenode(namenode_ip, homedir, storage)
+        except Exception as e:
+            print(e)
+        time.sleep(interval)
 
 
 if __name__ == '__main__':
@@ -149,9 +574,19 @@ if __name__ == '__main__':
                         help='Homedir of the FTP server')
     parser.add_argument('--namenode_ip', type=str, required=True,
                         help='IP of the Namenode')
+    parser.add_argument('--heartbeat_interval', type=float, default=3,
+                        help='Period of reporting free disk space to the Namenode')
+    parser.add_argument('--buffer_size', type=int, default=256 * 1024,
+                        help='Size of the buffers used for receiving and sending files in bytes')
+    parser.add_argument('--scrub_rate', type=int, default=8 * 1024 * 1024,
+                        help='Bytes per second read when checking stored blocks against their checksums, '
+                             '0 disables the checks')
+    parser.add_argument('--scrub_interval', type=float, default=3600,
+                        help='Pause between passes over stored blocks in seconds')
+    parser.add_argument('--digest_file', type=str, default=None,
+                        help='File keeping digests of the storage between runs, <homedir>.digests by default')
     args = parser.parse_args()
 
-    connect_to_namenode(args.namenode_ip, args.homedir)
     authorizer = DummyAuthorizer()
     auth_data = {'user': "Namenode", 'passwd': "1234576890"}
     authorizer.add_user(auth_data['user'], auth_data['passwd'], homedir=args.homedir, perm="elradfmwMT")
@@ -160,7 +595,20 @@ if __name__ == '__main__':
     handler = CustomizedFTPHandler
     handler.homedir = abspath(args.homedir)
     handler.auth_data = auth_data
+    handler.storage = StorageDigests(handler.homedir, args.digest_file or handler.homedir + DIGESTS_SUFFIX)
     handler.authorizer = authorizer
+    handler.dtp_handler.ac_in_buffer_size = args.buffer_size
+    handler.dtp_handler.ac_out_buffer_size = args.buffer_size
 
-    server = FTPServer((args.ip, 21), handler)
+    server = ThreadedFTPServer((args.ip, 21), handler)
+    # the server listens already, so replicas can be sent to the node as soon as it registers
+    connect_to_namenode(args.namenode_ip, args.homedir, handler.storage)
+    Thread(target=send_heartbeats, args=(args.namenode_ip, args.homedir, handler.storage, args.heartbeat_interval),
+           daemon=True).start()
+    if args.scrub_rate:
+        Thread(target=scrub, args=(args.namenode_ip, args.homedir, handler.storage, args.scrub_rate,
+                                   args.scrub_interval), daemon=True).start()
+    # serve_forever stops on SystemExit as on KeyboardInterrupt, so the digests are saved on SIGTERM too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
     server.serve_forever()
+    handler.storage.save()
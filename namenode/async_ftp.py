@@ -0,0 +1,168 @@
+import asyncio
+import math
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from ftplib import error_perm, error_proto, error_reply, error_temp
+
+from namenode.fan_out import FanOut, NodeResult, node_commands
+
+async_errors = (error_reply, error_temp, error_perm, error_proto, OSError, EOFError, asyncio.TimeoutError)
+
+
+class AsyncFTP:
+    """Control connection to a datanode speaking the part of FTP the namenode needs."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, host, port=21, user='', passwd=''):
+        reader, writer = await asyncio.open_connection(host, port)
+        ftp = cls(reader, writer)
+        await ftp.getresp()
+        response = await ftp.sendcmd(f'USER {user}')
+        if response[0] == '3':
+            response = await ftp.sendcmd(f'PASS {passwd}')
+        if response[0] != '2':
+            ftp.close()
+            raise error_reply(response)
+        return ftp
+
+    async def _getline(self):
+        line = await self.reader.readline()
+        if not line:
+            raise EOFError
+        return line.decode('utf-8').rstrip('\r\n')
+
+    async def getresp(self):
+        response = await self._getline()
+        if response[3:4] == '-':
+            code = response[:3]
+            while True:
+                line = await self._getline()
+                response += '\n' + line
+                if line[:3] == code and line[3:4] != '-':
+                    break
+        if response[:1] == '4':
+            raise error_temp(response)
+        if response[:1] == '5':
+            raise error_perm(response)
+        if response[:1] not in '123':
+            raise error_proto(response)
+        return response
+
+    async def sendcmd(self, command):
+        self.writer.write(f'{command}\r\n'.encode('utf-8'))
+        await self.writer.drain()
+        return await self.getresp()
+
+    async def voidcmd(self, command):
+        response = await self.sendcmd(command)
+        if response[:1] != '2':
+            raise error_reply(response)
+        return response
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncFTPConnectionPool:
+    def __init__(self, max_size=4, **auth_data):
+        self.max_size = max_size
+        self.auth_data = auth_data
+        self.idle = defaultdict(list)
+        self.slots = {}
+
+    async def _acquire(self, node):
+        while self.idle[node]:
+            ftp = self.idle[node].pop()
+            try:
+                await ftp.voidcmd('NOOP')
+                return ftp
+            except async_errors:
+                ftp.close()
+        return await AsyncFTP.connect(node, **self.auth_data)
+
+    def _release(self, node, ftp):
+        if len(self.idle[node]) < self.max_size:
+            self.idle[node].append(ftp)
+        else:
+            ftp.close()
+
+    @asynccontextmanager
+    async def connection(self, node):
+        if node not in self.slots:
+            self.slots[node] = asyncio.Semaphore(self.max_size)
+        async with self.slots[node]:
+            ftp = await self._acquire(node)
+            try:
+                yield ftp
+            except (error_perm, error_reply, error_temp):
+                self._release(node, ftp)
+                raise
+            except BaseException:
+                ftp.close()
+                raise
+            self._release(node, ftp)
+
+    def close(self):
+        for connections in self.idle.values():
+            for ftp in connections:
+                ftp.close()
+        self.idle.clear()
+
+
+class AsyncFanOutExecutor:
+    """Counterpart of FanOutExecutor multiplexing datanode commands on the event loop."""
+
+    def __init__(self, pool, timeout=10):
+        self.pool = pool
+        self.timeout = timeout
+
+    async def _send(self, node, commands):
+        responses = []
+        error = None
+        try:
+            async with self.pool.connection(node) as ftp:
+                for command in commands:
+                    try:
+                        responses.append(await ftp.voidcmd(command))
+                    except (error_perm, error_reply, error_temp) as e:
+                        responses.append(str(e))
+                        error = e
+        except async_errors as e:
+            return NodeResult(False, responses, e)
+        return NodeResult(error is None, responses, error)
+
+    async def _send_within(self, node, commands, timeout):
+        try:
+            return await asyncio.wait_for(self._send(node, commands), None if timeout == math.inf else timeout)
+        except asyncio.TimeoutError:
+            return NodeResult(False, [], TimeoutError(f'{node} did not answer in {timeout} s'))
+
+    async def run_each(self, calls, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        return list(await asyncio.gather(*(self._send_within(node, commands, timeout) for node, commands in calls)))
+
+    async def run(self, nodes, commands, timeout=None):
+        calls = node_commands(nodes, commands)
+        return {node: result for (node, _), result in zip(calls, await self.run_each(calls, timeout))}
+
+    async def perform(self, request):
+        if isinstance(request, FanOut):
+            return await self.run(request.nodes, request.commands, request.timeout)
+        return await self.run_each(request.calls, request.timeout)
+
+    async def drive(self, operation):
+        if not hasattr(operation, 'send'):
+            return operation
+        try:
+            request = next(operation)
+            while True:
+                request = operation.send(await self.perform(request))
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            operation.close()
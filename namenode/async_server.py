@@ -0,0 +1,78 @@
+import asyncio
+import json
+
+from namenode.async_ftp import AsyncFanOutExecutor, AsyncFTPConnectionPool
+from namenode.http_handler import Stream, route
+
+
+class AsyncNamenodeServer:
+    """Serves the endpoints of http_handler.Handler with every request being a task on one event loop.
+
+    Datanode requests yielded by the operations go through the asyncio FTP control client, so
+    slow datanodes hold neither a thread nor other requests.
+    """
+
+    def __init__(self, ftp_client, address, port, pool_size=4, node_timeout=10, backlog=1024, idle_timeout=120):
+        self.ftp_client = ftp_client
+        self.address = address
+        self.port = port
+        self.backlog = backlog
+        self.idle_timeout = idle_timeout
+        self.pool = AsyncFTPConnectionPool(pool_size, **ftp_client.auth_data)
+        self.fan_out = AsyncFanOutExecutor(self.pool, timeout=node_timeout)
+
+    @staticmethod
+    async def _read_request(reader):
+        request_line = await reader.readline()
+        if not request_line.strip():
+            return None
+        method, path, version = request_line.decode('latin-1').split()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, value = line.decode('latin-1').split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+        connection = headers.get('connection', '').lower()
+        keep_alive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+        return path, json.loads(body) if body else {}, keep_alive
+
+    async def handle(self, reader, writer):
+        client_ip = writer.get_extra_info('peername')[0]
+        try:
+            keep_alive = True
+            while keep_alive:
+                request = await asyncio.wait_for(self._read_request(reader), self.idle_timeout)
+                if request is None:
+                    break
+                path, args, keep_alive = request
+                answer = route(self.ftp_client, path, client_ip, args)
+                connection = b'' if keep_alive else b'Connection: close\r\n'
+                if isinstance(answer, Stream):
+                    writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n'
+                                 b'Transfer-Encoding: chunked\r\n%s\r\n' % connection)
+                    for chunk in answer.chunks:
+                        writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                        await writer.drain()
+                    writer.write(b'0\r\n\r\n')
+                else:
+                    payload = json.dumps({'msg': await self.fan_out.drive(answer)}).encode('utf-8')
+                    writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n%s\r\n'
+                                 % (len(payload), connection))
+                    writer.write(payload)
+                await writer.drain()
+        except (ConnectionResetError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle, self.address, self.port, backlog=self.backlog)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.pool.close()
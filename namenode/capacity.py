@@ -0,0 +1,71 @@
+import time
+from collections import defaultdict
+from threading import Lock
+
+
+class CapacityTable:
+    def __init__(self):
+        self.free = {}
+        self.last_seen = {}
+        self.reserved = defaultdict(int)
+        self.transfers = defaultdict(int)
+        self.reservations = {}
+        self.lock = Lock()
+
+    def __contains__(self, node):
+        return node in self.free
+
+    def update(self, node, free):
+        with self.lock:
+            self.free[node] = free
+            self.last_seen[node] = time.time()
+
+    def stale(self, timeout):
+        """Nodes which have not reported for longer than timeout seconds."""
+        now = time.time()
+        with self.lock:
+            return {node for node, seen in self.last_seen.items() if now - seen > timeout}
+
+    def forget(self, node):
+        with self.lock:
+            self.free.pop(node, None)
+            self.last_seen.pop(node, None)
+
+    def available(self, node):
+        with self.lock:
+            return self.free.get(node, 0) - self.reserved[node]
+
+    def outstanding(self, node):
+        with self.lock:
+            return self.transfers[node]
+
+    def reserve(self, key, sizes):
+        with self.lock:
+            self._drop(key)
+            self.reservations[key] = dict(sizes)
+            for node, size in sizes.items():
+                self.reserved[node] += size
+                self.transfers[node] += 1
+
+    def reservation(self, key):
+        with self.lock:
+            return self.reservations.get(key)
+
+    def _drop(self, key):
+        sizes = self.reservations.pop(key, {})
+        for node, size in sizes.items():
+            self.reserved[node] -= size
+            self.transfers[node] -= 1
+        return sizes
+
+    def release(self, key):
+        """Forget reservation of an aborted or expired write."""
+        with self.lock:
+            self._drop(key)
+
+    def commit(self, key):
+        """Turn reservation into used space until the next heartbeat of the nodes."""
+        with self.lock:
+            for node, size in self._drop(key).items():
+                if node in self.free:
+                    self.free[node] -= size
@@ -0,0 +1,90 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from ftplib import FTP, all_errors, error_perm, error_reply, error_temp
+from threading import BoundedSemaphore, Lock
+
+
+class FTPConnectionPool:
+    def __init__(self, max_size=4, timeout=None, **auth_data):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.auth_data = auth_data
+
+        self.idle = defaultdict(list)
+        self.slots = {}
+        self.lock = Lock()
+
+    def _slot(self, node):
+        with self.lock:
+            if node not in self.slots:
+                self.slots[node] = BoundedSemaphore(self.max_size)
+            return self.slots[node]
+
+    def _connect(self, node):
+        if self.timeout is None:
+            return FTP(node, **self.auth_data)
+        return FTP(node, timeout=self.timeout, **self.auth_data)
+
+    @staticmethod
+    def _alive(ftp):
+        try:
+            ftp.voidcmd('NOOP')
+            return True
+        except all_errors:
+            return False
+
+    @staticmethod
+    def _close(ftp):
+        try:
+            ftp.close()
+        except all_errors:
+            pass
+
+    def _acquire(self, node):
+        while True:
+            with self.lock:
+                ftp = self.idle[node].pop() if self.idle[node] else None
+            if ftp is None:
+                return self._connect(node)
+            if self._alive(ftp):
+                return ftp
+            self._close(ftp)
+
+    def _release(self, node, ftp):
+        # the socket may have been given a longer timeout for a transfer
+        ftp.sock.settimeout(self.timeout)
+        with self.lock:
+            if len(self.idle[node]) < self.max_size:
+                self.idle[node].append(ftp)
+                return
+        self._close(ftp)
+
+    @contextmanager
+    def connection(self, node):
+        slot = self._slot(node)
+        slot.acquire()
+        try:
+            ftp = self._acquire(node)
+            try:
+                yield ftp
+            except (error_perm, error_reply, error_temp):
+                self._release(node, ftp)
+                raise
+            except BaseException:
+                self._close(ftp)
+                raise
+            self._release(node, ftp)
+        finally:
+            slot.release()
+
+    def discard(self, node):
+        with self.lock:
+            connections = self.idle.pop(node, [])
+        for ftp in connections:
+            self._close(ftp)
+
+    def close(self):
+        with self.lock:
+            nodes = list(self.idle)
+        for node in nodes:
+            self.discard(node)
@@ -0,0 +1,54 @@
+import hashlib
+
+from namenode.fs_tree import node_id
+
+
+def entries_digest(dirs, files):
+    """Digest of a directory from {name: digest} of its subdirectories and {name: block indices} of its files.
+
+    Datanodes compute the same digest over their storage, see datanode/ftp_server.py.
+    """
+    entries = sorted([f'd/{name}/{digest}' for name, digest in dirs.items()] +
+                     [f"f/{name}/{','.join(map(str, sorted(indices)))}" for name, indices in files.items()])
+    return hashlib.blake2b('\0'.join(entries).encode(), digest_size=16).hexdigest()
+
+
+class NodeView:
+    """The part of the namespace a datanode should store: every directory and its replicas of file blocks.
+
+    Digests are kept in the directories across views and calls, the tree forgets them along the path of
+    every change (Directory.forget_digests), so only the changed directories are digested again.
+    """
+
+    def __init__(self, node):
+        self.node = node
+        self.id = node_id(node)
+
+    def entries(self, directory):
+        files = {}
+        for name, file in directory.children_files.items():
+            indices = [block.index for block in file.blocks if self.node in block.nodes]
+            if indices:
+                files[name] = indices
+        return {name: self.digest(child) for name, child in directory.children_directories.items()}, files
+
+    def _cached(self, directory):
+        digests = directory.digests
+        return None if digests is None else digests.get(self.id)
+
+    def digest(self, directory):
+        stack = [directory]
+        while stack:
+            current = stack[-1]
+            pending = [child for child in current.children_directories.values() if self._cached(child) is None]
+            if pending:
+                stack.extend(pending)
+                continue
+            stack.pop()
+            digest = self._cached(current)
+            if digest is None:
+                digest = entries_digest(*self.entries(current))
+                if current.digests is None:
+                    current.digests = {}
+                current.digests[self.id] = digest
+        return digest
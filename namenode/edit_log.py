@@ -0,0 +1,237 @@
+import json
+import os
+from operator import attrgetter
+from os.path import exists, join
+from threading import Lock, Thread
+
+from namenode.fs_tree import Block, Directory, datanode_ips
+
+_block_fields = attrgetter('size', '_nodes', 'checksum')
+
+
+def _split(root, path):
+    parent_path, name = os.path.split(path)
+    parent = root
+    for component in parent_path.split('/'):
+        if component:
+            parent = parent.children_directories[component]
+    return parent, name
+
+
+def drop_node(root, ip):
+    """Forget the replicas of a dead datanode in the whole tree, return the blocks which had one."""
+    blocks = []
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        for file in directory.children_files.values():
+            blocks.extend(block for block in file.blocks if block.drop_node(ip))
+        stack.extend(directory.children_directories.values())
+    return blocks
+
+
+def apply_edit(root, edit):
+    """Apply namespace mutation to the tree and return its (possibly new) root."""
+    op, args = edit[0], edit[1:]
+    if op == 'init':
+        return Directory('/')
+    if op == 'drop_node':
+        drop_node(root, args[0])
+        return root
+
+    parent, name = _split(root, args[0])
+    if op == 'mkdir':
+        parent.add_directory(name)
+    elif op == 'rmdir':
+        parent.delete_directory(name)
+    elif op == 'rm':
+        parent.delete_file(name)
+    elif op == 'mv':
+        file = parent.delete_file(name)
+        new_parent, new_name = _split(root, args[1])
+        new_parent.attach_file(file, new_name)
+    elif op == 'file':
+        size, blocks, *mtime = args[1:]
+        file = parent.children_files[name] if name in parent.children_files else parent.add_file(name)
+        file.size = size
+        file.mtime = mtime[0] if mtime else None
+        file.blocks = [Block(file, index, *block) for index, block in enumerate(blocks)]
+    else:
+        raise ValueError(f'Unknown edit {op}')
+    return root
+
+
+def _blocks(blocks, replicas=None):
+    replicas = replicas or {}
+    return [[block.size, sorted(replicas.get(block, block.nodes)), block.checksum] for block in blocks]
+
+
+def file_edit(file, blocks=None, mtime=None, replicas=None):
+    """Edit recording the file as it is, or as it is about to be with the given blocks, mtime and replicas.
+
+    Edits are logged before the tree is changed, so callers pass what they are going to set:
+    replicas maps the blocks whose datanodes change to their new datanodes.
+    """
+    size = file.size if blocks is None else sum(block.size for block in blocks)
+    return ['file', str(file), size, _blocks(file.blocks if blocks is None else blocks, replicas),
+            file.mtime if mtime is None else mtime]
+
+
+def capture_tree(root):
+    """Copy the fields snapshot_edits needs, quickly enough to be done under the tree lock.
+
+    Returns (path, files) pairs, files holding (name, size, mtime, blocks) with the blocks as
+    (size, datanode ids, checksum), so the tree may change while the copy is serialized.
+    """
+    directories = []
+    stack = [('/', root)]
+    while stack:
+        path, directory = stack.pop()
+        directories.append((path, [(name, file.size, file.mtime, [*map(_block_fields, file.blocks)])
+                                   for name, file in directory.children_files.items()]))
+        stack.extend((join(path, name), child) for name, child in directory.children_directories.items())
+    return directories
+
+
+def snapshot_edits(directories):
+    for path, files in directories:
+        if path != '/':
+            yield ['mkdir', path]
+        for name, size, mtime, blocks in files:
+            blocks = [[block_size, sorted(datanode_ips[node] for node in nodes), checksum]
+                      for block_size, nodes, checksum in blocks]
+            yield ['file', join(path, name), size, blocks, mtime]
+
+
+class EditLog:
+    """Append-only log of namespace mutations with periodic snapshots of the whole tree.
+
+    Every line of both files is a JSON list. The snapshot starts with ["image", txid] followed by
+    the edits which rebuild the tree, the log consists of [txid, op, args...] lines. On startup the
+    snapshot is loaded and only the log entries newer than it are replayed.
+
+    An edit is written and synced before the tree is changed. A line without its newline was cut
+    short by a crash, so it is dropped together with anything after it, even if it parses.
+
+    A checkpoint only copies the fields of the tree it needs while the caller holds the tree lock, a
+    background thread turns the copy into edits, writes and syncs the snapshot and then cuts the entries
+    it covers off the log. Requests wait for the copy but not for the serialization or the disk, at the
+    cost of memory for the copy until it is written. Until the log is cut a crash replays those entries
+    on top of the previous snapshot.
+    """
+
+    def __init__(self, meta_dir=None, checkpoint_edits=100000):
+        self.meta_dir = meta_dir
+        self.checkpoint_edits = checkpoint_edits
+        self.txid = 0
+        self.edits = 0
+        self.log_file = None
+        # the log file is written by log() and replaced by the snapshot writer
+        self.lock = Lock()
+        self.writer = None
+        if meta_dir is not None:
+            os.makedirs(meta_dir, exist_ok=True)
+            self.snapshot_path = join(meta_dir, 'fsimage')
+            self.edits_path = join(meta_dir, 'edits')
+
+    def load(self):
+        root = Directory('/')
+        if self.meta_dir is None:
+            return root
+
+        if exists(self.snapshot_path):
+            with open(self.snapshot_path) as snapshot:
+                self.txid = json.loads(snapshot.readline())[1]
+                for line in snapshot:
+                    root = apply_edit(root, json.loads(line))
+
+        valid_size = 0
+        if exists(self.edits_path):
+            with open(self.edits_path, 'rb') as log:
+                for line in log:
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        edit = json.loads(line)
+                    except ValueError:
+                        break
+                    valid_size += len(line)
+                    if edit[0] > self.txid:
+                        root = apply_edit(root, edit[1:])
+                        self.txid = edit[0]
+                        self.edits += 1
+
+        self.log_file = open(self.edits_path, 'ab', buffering=0)
+        self.log_file.truncate(valid_size)
+        return root
+
+    def log(self, *edit):
+        if self.log_file is None:
+            return
+        line = json.dumps([self.txid + 1, *edit]).encode('utf-8') + b'\n'
+        with self.lock:
+            size = self.log_file.tell()
+            try:
+                if self.log_file.write(line) != len(line):
+                    raise OSError(f'Edit was written only partially to {self.edits_path}')
+                os.fsync(self.log_file.fileno())
+            except OSError:
+                # the caller does not change the tree, so the log must not keep any part of the edit either
+                self.log_file.truncate(size)
+                raise
+        self.txid += 1
+        self.edits += 1
+
+    def checkpoint(self, root, wait=False):
+        """Snapshot the tree as of the last logged edit, the caller holds the tree lock.
+
+        Returns at once if the previous snapshot is still being written, unless wait is set, which also
+        waits for this one to be written.
+        """
+        if self.log_file is None:
+            return
+        if self.writer is not None and self.writer.is_alive():
+            if not wait:
+                return
+            self.writer.join()
+        directories = capture_tree(root)
+        with self.lock:
+            log_size = self.log_file.tell()
+        self.edits = 0
+        self.writer = Thread(target=self._write_snapshot, args=(self.txid, directories, log_size), daemon=True)
+        self.writer.start()
+        if wait:
+            self.writer.join()
+
+    def _write_snapshot(self, txid, directories, log_size):
+        tmp_path = self.snapshot_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as file:
+                file.write(json.dumps(['image', txid]) + '\n')
+                for edit in snapshot_edits(directories):
+                    file.write(json.dumps(edit) + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+
+            # the first log_size bytes of the log are in the snapshot, edits logged since then are kept
+            with self.lock:
+                with open(self.edits_path, 'rb') as log:
+                    log.seek(log_size)
+                    tail = log.read()
+                with open(self.edits_path + '.tmp', 'wb') as log:
+                    log.write(tail)
+                    log.flush()
+                    os.fsync(log.fileno())
+                os.replace(self.edits_path + '.tmp', self.edits_path)
+                self.log_file.close()
+                self.log_file = open(self.edits_path, 'ab', buffering=0)
+        except OSError as e:
+            print(f'Snapshot was not written: {e!r}')
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.join()
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
@@ -0,0 +1,169 @@
+import math
+import time
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from ftplib import all_errors, error_perm, error_reply, error_temp
+from threading import Condition
+
+NodeResult = namedtuple('NodeResult', ['ok', 'responses', 'error'])
+
+# Datanode requests yielded by namenode operations, answered by an executor's drive().
+# FanOut is answered with {node: NodeResult}, NodeCalls with a list of NodeResult in the order
+# of its (node, commands) calls. Timeout None means the executor default, math.inf no limit.
+FanOut = namedtuple('FanOut', ['nodes', 'commands', 'timeout'], defaults=[None])
+NodeCalls = namedtuple('NodeCalls', ['calls', 'timeout'], defaults=[None])
+
+
+def node_commands(nodes, commands):
+    if isinstance(commands, str):
+        commands = [commands]
+    if callable(commands):
+        return [(node, commands(node)) for node in nodes]
+    return [(node, commands) for node in nodes]
+
+
+def _part(result, start, count):
+    responses = result.responses[start:start + count]
+    ok = len(responses) == count and all(response[:1] == '2' for response in responses)
+    return NodeResult(ok, responses, None if ok else result.error)
+
+
+def coalesce(requests):
+    """Merge datanode requests of several operations into one FanOut with a single command list per node.
+
+    Returns the FanOut and a function splitting its results into the answers to each request.
+    """
+    commands = defaultdict(list)
+    parts = []
+    for request in requests:
+        calls = node_commands(request.nodes, request.commands) if isinstance(request, FanOut) else request.calls
+        request_parts = []
+        for node, node_calls in calls:
+            request_parts.append((node, len(commands[node]), len(node_calls)))
+            commands[node].extend(node_calls)
+        parts.append((request, request_parts))
+
+    timeouts = [request.timeout for request in requests]
+    timeout = math.inf if math.inf in timeouts else max((t for t in timeouts if t is not None), default=None)
+
+    def split(results):
+        answers = []
+        for request, request_parts in parts:
+            part_results = [_part(results[node], start, count) for node, start, count in request_parts]
+            if isinstance(request, FanOut):
+                answers.append({node: result for (node, _, _), result in zip(request_parts, part_results)})
+            else:
+                answers.append(part_results)
+        return answers
+
+    return FanOut(list(commands), lambda node: commands[node], timeout), split
+
+
+class FanOutExecutor:
+    """Runs datanode commands on a thread pool, the pool's sockets time out like the calls do.
+
+    The time of a call is counted from the moment it has its connection, calls waiting for a worker
+    or for a connection of the node are not failed, as they are still going to be sent. A call which
+    does not finish in time is reported as failed at once. It cannot be stopped, so it stays in late
+    until its socket times out or the datanode answers.
+    """
+
+    def __init__(self, pool, max_workers=32, timeout=10):
+        self.pool = pool
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.late = set()
+
+    def _send(self, node, commands, timeout, started=None):
+        responses = []
+        error = None
+        try:
+            with self.pool.connection(node) as ftp:
+                if started is not None:
+                    started()
+                ftp.sock.settimeout(None if timeout == math.inf else timeout)
+                for command in commands:
+                    try:
+                        responses.append(ftp.voidcmd(command))
+                    except (error_perm, error_reply, error_temp) as e:
+                        responses.append(str(e))
+                        error = e
+        except all_errors as e:
+            return NodeResult(False, responses, e)
+        return NodeResult(error is None, responses, error)
+
+    def run_each(self, calls, timeout=None):
+        """Send every (node, commands) call over its own connection at once, results keep the order of calls."""
+        if timeout is None:
+            timeout = self.timeout
+        deadlines = [None] * len(calls)
+        changed = Condition()
+
+        def started(index):
+            with changed:
+                deadlines[index] = time.monotonic() + timeout
+                changed.notify()
+
+        def finished(future):
+            with changed:
+                changed.notify()
+
+        futures = [self.executor.submit(self._send, node, commands, timeout, lambda index=index: started(index))
+                   for index, (node, commands) in enumerate(calls)]
+        for future in futures:
+            future.add_done_callback(finished)
+        with changed:
+            while True:
+                now = time.monotonic()
+                pending = [deadlines[index] for index, future in enumerate(futures) if not future.done()]
+                if all(deadline is not None and deadline <= now for deadline in pending):
+                    break
+                left = min((deadline - now for deadline in pending if deadline is not None and deadline > now),
+                           default=math.inf)
+                changed.wait(None if left == math.inf else left)
+
+        results = []
+        for (node, commands), future in zip(calls, futures):
+            if future.done():
+                results.append(future.result())
+                continue
+            if not future.cancel():
+                self.late.add(future)
+                future.add_done_callback(self.late.discard)
+            results.append(NodeResult(False, [], TimeoutError(f'{node} did not answer in {timeout} s')))
+        return results
+
+    def run(self, nodes, commands, timeout=None):
+        """Send FTP commands to all nodes at once and collect per-node results.
+
+        commands is either a single command, a list of commands, or a function
+        mapping a node to its own list of commands. Nodes which do not answer
+        within the timeout are reported as failed.
+        """
+        calls = node_commands(nodes, commands)
+        return {node: result for (node, _), result in zip(calls, self.run_each(calls, timeout))}
+
+    def perform(self, request):
+        if isinstance(request, FanOut):
+            return self.run(request.nodes, request.commands, request.timeout)
+        return self.run_each(request.calls, request.timeout)
+
+    def drive(self, operation):
+        """Run a namenode operation, answering the datanode requests it yields until it returns."""
+        if not hasattr(operation, 'send'):
+            return operation
+        try:
+            request = next(operation)
+            while True:
+                request = operation.send(self.perform(request))
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            operation.close()
+
+    @staticmethod
+    def succeeded(results):
+        return {node for node, result in results.items() if result.ok}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -1,122 +1,211 @@
+import bisect
+import itertools
 import os
+import sys
+import time
+from types import MappingProxyType
+
+_no_children = MappingProxyType({})
+
+# Sorted names are kept only for directories this large, smaller ones are sorted on every call
+SORTED_NAMES_MIN_SIZE = 1024
+
+datanode_ids = {}
+datanode_ips = []
+
+
+def datanode_address(ip):
+    """Name the datanode is known by, FTP connections to a datanode on the namenode host go to localhost."""
+    return 'localhost' if ip == '127.0.0.1' else ip
+
+
+def node_id(ip):
+    """Small integer standing for the datanode in block replica lists."""
+    if ip not in datanode_ids:
+        datanode_ids[ip] = len(datanode_ips)
+        datanode_ips.append(ip)
+    return datanode_ids[ip]
 
 
 class Directory:
+    __slots__ = ('parent', 'name', '_path', '_files', '_directories', '_sorted_names', 'digests', 'read_counter',
+                 'write_counter')
+
     def __init__(self, name, parent=None):
         self.parent = parent
-        self.name = name
-        self.children_files = {}
-        self.children_directories = {}
+        self.name = sys.intern(name)
+        self._path = None
+        self._files = None
+        self._directories = None
+        self._sorted_names = None
+        # {datanode id: digest of what the datanode stores in the subtree}, see namenode/digest.py
+        self.digests = None
 
         self.read_counter = 0
         self.write_counter = 0
 
+    @property
+    def children_files(self):
+        return self._files if self._files is not None else _no_children
+
+    @property
+    def children_directories(self):
+        return self._directories if self._directories is not None else _no_children
+
     def __str__(self):
-        if self.parent is None:
-            return self.name
-        else:
-            return os.path.join(str(self.parent), self.name)
+        if self._path is None:
+            uncached = []
+            directory = self
+            while directory is not None and directory._path is None:
+                uncached.append(directory)
+                directory = directory.parent
+            for directory in reversed(uncached):
+                parent = directory.parent
+                directory._path = directory.name if parent is None else os.path.join(parent._path, directory.name)
+        return self._path
 
     def __contains__(self, item):
         return item in self.children_files or item in self.children_directories
 
-    def __hash__(self):
-        return hash(str(self))
+    def sorted_names(self):
+        """Names of all children in order, large directories sort them again only after they have changed."""
+        if self._sorted_names is not None:
+            return self._sorted_names
+        names = sorted(itertools.chain(self.children_files, self.children_directories))
+        if len(names) >= SORTED_NAMES_MIN_SIZE:
+            self._sorted_names = names
+        return names
+
+    def page(self, start_after=None, limit=None):
+        """Sorted names of the children following start_after, and whether more of them are left."""
+        names = self.sorted_names()
+        start = 0 if start_after is None else bisect.bisect_right(names, start_after)
+        end = len(names) if limit is None else start + limit
+        return names[start:end], end < len(names)
 
     def to_dict(self):
         files = [name for name, obj in self.children_files.items()]
         dirs = {name: obj.to_dict() for name, obj in self.children_directories.items()}
         return {'f': files, 'd': dirs}
 
+    def _subtree_locked(self, count_readers):
+        stack = [self]
+        while stack:
+            directory = stack.pop()
+            nodes = [directory, *directory.children_files.values()]
+            if any(node.write_counter or (count_readers and node.read_counter) for node in nodes):
+                return True
+            stack.extend(directory.children_directories.values())
+        return False
+
     def readable(self):
-        return self.write_counter == 0
+        """Locks are counted only on the locked node, so the subtree is checked here instead."""
+        return not self._subtree_locked(False)
 
     def writable(self):
-        return self.write_counter == 0 and self.read_counter == 0
+        return not self._subtree_locked(True)
 
     def empty(self):
-        return len(self.children_directories) == 0 and len(self.children_files) == 0
-
-    def get_root(self):
-        if self.name == '/':
-            return self
-        else:
-            return self.parent.get_root()
-
-    def get_absolute_path(self, path):
-        sw = lambda x, s: x.startswith(s)
-        cur_dir = self
-        while sw(path, '/') or sw(path, '../') or sw(path, './') or '/' in path:
-            if path.startswith('/'):
-                cur_dir = self.get_root()
-                path = path[1:]
-            elif path.startswith('../'):
-                if cur_dir != self.get_root():
-                    cur_dir = cur_dir.parent
-                path = path[3:]
-            elif path.startswith('./'):
-                path = path[2:]
-            elif isinstance(cur_dir, File):
-                return None, "No such directory."
-            else:
-                parent_dir, path = path.split('/', 1)
-                if parent_dir in cur_dir:
-                    cur_dir = cur_dir.children_directories[parent_dir]
-                else:
-                    return None, "No such file or directory."
-        return cur_dir, os.path.join(str(cur_dir), path.split('/')[-1])
+        return not self._directories and not self._files
+
+    def forget_digests(self):
+        """Digests cover the whole subtree, so a change of the directory forgets them up to the root.
+
+        A directory keeps digests only while all its subdirectories keep them, so the walk stops at the
+        first directory without any.
+        """
+        directory = self
+        while directory is not None and directory.digests is not None:
+            directory.digests = None
+            directory = directory.parent
 
     def add_file(self, file_name):
-        new_file = File(file_name, self)
-        self.children_files[file_name] = new_file
-        return new_file
+        return self.attach_file(File(file_name, self))
+
+    def attach_file(self, file, file_name=None):
+        if file_name is not None:
+            file.name = sys.intern(file_name)
+        file.parent = self
+        file._path = None
+        self._sorted_names = None
+        self.forget_digests()
+        if self._files is None:
+            self._files = {}
+        self._files[file.name] = file
+        return file
 
     def delete_file(self, file_name):
-        return self.children_files.pop(file_name)
+        file = self._files.pop(file_name)
+        self._sorted_names = None
+        self.forget_digests()
+        if not self._files:
+            self._files = None
+        return file
 
     def add_directory(self, dir_name):
         new_dir = Directory(dir_name, self)
-        self.children_directories[dir_name] = new_dir
+        self._sorted_names = None
+        self.forget_digests()
+        if self._directories is None:
+            self._directories = {}
+        self._directories[new_dir.name] = new_dir
         return new_dir
 
     def delete_directory(self, dir_name):
-        return self.children_directories.pop(dir_name)
+        directory = self._directories.pop(dir_name)
+        self._sorted_names = None
+        self.forget_digests()
+        if not self._directories:
+            self._directories = None
+        return directory
 
     def set_read_lock(self):
-        if self.parent is not None:
-            self.parent.set_read_lock()
         self.read_counter += 1
 
     def release_read_lock(self):
-        if self.parent is not None:
-            self.parent.release_read_lock()
         self.read_counter -= 1
 
     def set_write_lock(self):
-        if self.parent is not None:
-            self.parent.set_write_lock()
         self.write_counter += 1
 
     def release_write_lock(self):
-        if self.parent is not None:
-            self.parent.release_write_lock()
         self.write_counter -= 1
 
 
 class File:
+    __slots__ = ('parent', 'name', '_path', '_blocks', 'read_counter', 'write_counter', 'size', 'mtime')
+
     def __init__(self, name, parent):
         self.parent = parent
-        self.name = name
-        self.nodes = set()
+        self.name = sys.intern(name)
+        self._path = None
+        self.blocks = []
         self.read_counter = 0
         self.write_counter = 0
         self.size = 0
+        self.mtime = time.time()
 
     def __str__(self):
-        return os.path.join(str(self.parent), self.name)
+        if self._path is None:
+            self._path = os.path.join(str(self.parent), self.name)
+        return self._path
+
+    @property
+    def blocks(self):
+        return self._blocks
 
-    def __hash__(self):
-        return hash(str(self))
+    @blocks.setter
+    def blocks(self, blocks):
+        self._blocks = blocks
+        self.forget_digests()
+
+    @property
+    def nodes(self):
+        return set().union(*(block.nodes for block in self.blocks))
+
+    def forget_digests(self):
+        if self.parent is not None:
+            self.parent.forget_digests()
 
     def readable(self):
         return self.write_counter == 0
@@ -125,17 +214,50 @@ class File:
         return self.write_counter == 0 and self.read_counter == 0
 
     def set_read_lock(self):
-        self.parent.set_read_lock()
         self.read_counter += 1
 
     def release_read_lock(self):
-        self.parent.release_read_lock()
         self.read_counter -= 1
 
     def set_write_lock(self):
-        self.parent.set_write_lock()
         self.write_counter += 1
 
     def release_write_lock(self):
-        self.parent.release_write_lock()
         self.write_counter -= 1
+
+
+class Block:
+    """Part of the file stored on datanodes as <file path>/<index>.
+
+    Replicas are kept as a tuple of datanode ids, the nodes property translates them to IPs.
+    checksum is the CRC32 of the block content, None for blocks written before checksums existed.
+    """
+    __slots__ = ('file', 'index', 'size', '_nodes', 'checksum')
+
+    def __init__(self, file, index, size, nodes=(), checksum=None):
+        self.file = file
+        self.index = index
+        self.size = size
+        self.nodes = nodes
+        self.checksum = checksum
+
+    @property
+    def nodes(self):
+        return {datanode_ips[node] for node in self._nodes}
+
+    @nodes.setter
+    def nodes(self, nodes):
+        self._nodes = tuple(sorted(node_id(node) for node in nodes))
+        self.file.forget_digests()
+
+    def drop_node(self, ip):
+        """Forget the replica on the datanode, return whether there was one."""
+        node = datanode_ids.get(ip)
+        if node not in self._nodes:
+            return False
+        self._nodes = tuple(other for other in self._nodes if other != node)
+        self.file.forget_digests()
+        return True
+
+    def __str__(self):
+        return os.path.join(str(self.file), str(self.index))
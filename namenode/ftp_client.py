@@ -1,41 +1,72 @@
 import os
-from datetime import datetime
-from ftplib import FTP
-from threading import Thread
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
 
-from namenode.fs_tree import Directory, File
+from namenode.capacity import CapacityTable
+from namenode.connection_pool import FTPConnectionPool
+from namenode.digest import NodeView
+from namenode.edit_log import file_edit
+from namenode.fan_out import FanOut, FanOutExecutor, NodeCalls, coalesce
+from namenode.fs_tree import Block, Directory, File, datanode_address
+from namenode.placement import placement_policies
 
-
-def create_replica(status, source_ip, dest_ip, path_from, path_to, auth_data):
-    try:
-        with FTP(source_ip, **auth_data) as ftp:
-            responce = ftp.sendcmd(f"REPL {path_from} {path_to} {dest_ip}").split(' ')[0]
-            status[dest_ip] = responce == '250'
-    except ConnectionRefusedError:
-        status[dest_ip] = False
+# Slowest copy speed in bytes per second expected from REPL before the copy is considered hung
+MIN_TRANSFER_RATE = 1024 * 1024
 
 
 class FTPClient:
-    def __init__(self, namenode, num_replicas, **auth_data):
+    """Namenode operations over the file system tree.
+
+    Operations talking to datanodes are generators: they yield FanOut or NodeCalls requests
+    between their metadata steps and get the results back, so the same code is driven by the
+    blocking fan_out executor or by the asyncio one. fan_out.drive() runs any operation.
+    """
+
+    def __init__(self, namenode, num_replicas, pool_size=4, node_timeout=10, placement='power_of_two',
+                 block_size=64 * 1024 * 1024, **auth_data):
         self.num_replicas = num_replicas
+        self.block_size = block_size
         self.namenode = namenode
         self.datanodes = set()
 
         self.auth_data = auth_data
+        self.pool = FTPConnectionPool(pool_size, timeout=node_timeout, **auth_data)
+        self.fan_out = FanOutExecutor(self.pool, timeout=node_timeout)
+        self.capacity = CapacityTable()
+        self.placement = placement_policies[placement](self.capacity)
+        self.pending_blocks = {}
+        self.deleting = set()
+        self.incoming = set()
+        self.batch_operations = {
+            'create': self.create_file,
+            'mkdir': self.create_directory,
+            'rm': self.remove_file,
+            'rmdir': self.delete_directory,
+            'copy': self.copy_file,
+            'move': self.move_file,
+            'ls': self.read_directory,
+            'read': self.read_file,
+            'write': self.write_file,
+            'replicate': self.replicate_file,
+            'update_lock': self.namenode.update_lock,
+            'release_lock': self.namenode.release_lock,
+        }
+        self.client_operations = {'read', 'write', 'replicate', 'update_lock', 'release_lock'}
+
+    def close(self):
+        self.fan_out.shutdown()
+        self.pool.close()
 
     def initialize(self):
-        disk_sizes = []
-        for datanode in self.datanodes:
-            try:
-                with FTP(datanode, **self.auth_data) as ftp:
-                    ftp.voidcmd("RMDCONT /")
-                    available_size = ftp.sendcmd("AVBL /").split(' ')[4]
-                    disk_sizes.append(int(available_size))
-            except ConnectionRefusedError:
-                continue
+        results = yield FanOut(self.datanodes, ["RMDCONT /", "AVBL /"])
+        disk_sizes = [int(result.responses[1].split(' ')[4]) for result in results.values() if result.ok]
 
+        with self.namenode.tree_lock.write():
+            self.namenode.log_edit('init')
             self.namenode.fs_tree = Directory('/')
             self.namenode.work_dir = self.namenode.fs_tree
+            self.namenode.paths.clear()
         result = sum(disk_sizes)
         units = ['B', 'KB', 'MB', 'GB', 'TB']
         i = 0
@@ -45,166 +76,245 @@ class FTPClient:
         return f"Available size of the storage is {round(result, 2)} {units[i]}"
 
     def get_file(self, file_path):
-        parent_dir, abs_path = self.namenode.work_dir.get_absolute_path(file_path)
-        if parent_dir is None:
-            return None, 'Incorrect path', None
+        return self.namenode.resolve(file_path)
 
-        file_name = file_path.split('/')[-1]
-        abs_path = os.path.join(str(parent_dir), file_name)
-        return parent_dir, abs_path, file_name
+    def get_dir(self, dir_path):
+        return self.namenode.resolve(dir_path)
 
-    def get_dir(self, file_path):
-        parent_dir, abs_path = self.namenode.work_dir.get_absolute_path(file_path)
-        if parent_dir is None:
-            return None, 'Incorrect path', None
+    def _being_deleted(self, directory):
+        """Whether the directory is inside one whose RMTREE is running, anything added there would be wiped."""
+        while self.deleting and directory is not None:
+            if directory in self.deleting:
+                return True
+            directory = directory.parent
+        return False
 
-        if str(parent_dir) == abs_path:
-            return parent_dir, str(parent_dir), str(parent_dir)
-        else:
-            file_name = file_path.split('/')[-1]
-            abs_path = os.path.join(str(parent_dir), file_name)
-            return parent_dir, abs_path, file_name
+    def _name_taken(self, directory, name):
+        """Whether the name is used in the directory or kept for a file being moved or copied there."""
+        return name in directory or (directory, name) in self.incoming
 
     def create_file(self, file_path):
-        parent_dir, abs_path, file_name = self.get_file(file_path)
-        if parent_dir is None:
-            return abs_path
-
-        if file_name in parent_dir:
-            return 'File already exists.'
-
-        file = parent_dir.add_file(file_name)
-        file.set_write_lock()
-        try:
-            selected_datanodes = set()
-            for datanode in self.datanodes:
-                if len(selected_datanodes) > self.num_replicas:
-                    break
-                try:
-                    with FTP(datanode, **self.auth_data) as ftp:
-                        ftp.voidcmd(f"CRF {abs_path}")
-                        selected_datanodes.add(datanode)
-                except ConnectionRefusedError:
-                    continue
-            file.nodes = selected_datanodes
-            file.release_write_lock()
-        except Exception as e:
-            file.release_write_lock()
-            parent_dir.delete_file(file_name)
-            return 'File was not created due to internal error.'
+        with self.namenode.tree_lock.write():
+            parent_dir, abs_path, file_name = self.get_file(file_path)
+            if parent_dir is None:
+                return abs_path
+            if self._being_deleted(parent_dir):
+                return 'Directory is being deleted.'
+
+            if self._name_taken(parent_dir, file_name):
+                return 'File already exists.'
+
+            file = File(file_name, parent_dir)
+            self.namenode.log_edit(*file_edit(file))
+            parent_dir.attach_file(file)
         return ''
 
+    @staticmethod
+    def _block_info(block):
+        return {'path': str(block), 'size': block.size, 'ips': list(block.nodes), 'checksum': block.checksum}
+
     def read_file(self, file_path, client_ip):
-        parent_dir, abs_path, file_name = self.get_file(file_path)
-        if parent_dir is None:
-            return abs_path
+        with self.namenode.tree_lock.write():
+            parent_dir, abs_path, file_name = self.get_file(file_path)
+            if parent_dir is None:
+                return abs_path
 
-        if file_name not in parent_dir:
-            return 'File does not exist.'
+            if file_name not in parent_dir:
+                return 'File does not exist.'
 
-        file = parent_dir.children_files[file_name]
-        if not file.readable():
-            return 'File is being written. Reading cannot be performed.'
+            file = parent_dir.children_files[file_name]
+            if not file.readable():
+                return 'File is being written. Reading cannot be performed.'
 
-        self.namenode.set_lock(client_ip, file, 0)
-        return {'ips': list(file.nodes), 'path': abs_path}
+            self.namenode.set_lock(client_ip, file, 0)
+            return {'path': abs_path, 'size': file.size, 'lock_duration': self.namenode.lock_duration,
+                    'blocks': [self._block_info(block) for block in file.blocks]}
 
     def write_file(self, file_path, client_ip, file_size):
-        parent_dir, abs_path, file_name = self.get_file(file_path)
-        if parent_dir is None:
-            return abs_path
-
-        if file_name in parent_dir:
-            file = parent_dir.children_files[file_name]
-            if not file.writable():
+        yield from self._refresh_capacity()
+        with self.namenode.tree_lock.write():
+            parent_dir, abs_path, file_name = self.get_file(file_path)
+            if parent_dir is None:
+                return abs_path
+            if self._being_deleted(parent_dir):
+                return 'Directory is being deleted.'
+
+            if (parent_dir, file_name) in self.incoming:
                 return 'File is blocked by another process. Writing cannot be performed.'
-        else:
-            file = parent_dir.add_file(file_name)
-        self.namenode.set_lock(client_ip, file, 1)
-
-        selected_nodes = self._select_datanodes_for_write(file, file_size)
-        if len(selected_nodes) == 0:
+            if file_name in parent_dir:
+                file = parent_dir.children_files[file_name]
+                if not file.writable():
+                    return 'File is blocked by another process. Writing cannot be performed.'
+            else:
+                file = File(file_name, parent_dir)
+                self.namenode.log_edit(*file_edit(file))
+                parent_dir.attach_file(file)
+            self.namenode.set_lock(client_ip, file, 1)
+
+            new_blocks, sizes = self._place_blocks(file, file_size)
+            if new_blocks is None:
+                self.namenode.release_lock(client_ip, abs_path)
+                return 'There is no available nodes to store file'
+            else:
+                self.pending_blocks[file] = new_blocks
+                self.capacity.reserve(file, sizes)
+                return {'path': abs_path, 'block_size': self.block_size,
+                        'lock_duration': self.namenode.lock_duration,
+                        'blocks': [self._block_info(block) for block in new_blocks]}
+
+    def abort_write(self, file):
+        self.pending_blocks.pop(file, None)
+        self.capacity.release(file)
+
+    def _replication_plan(self, block, node_ip, replicas):
+        storing_nodes = {node_ip}.union(block.nodes.intersection(replicas))
+        left_nodes = [node for node in block.nodes if node not in storing_nodes]
+        return storing_nodes, left_nodes[:max(self.num_replicas - len(storing_nodes), 0)]
+
+    def replicate_file(self, file_path, client_ip, blocks):
+        with self.namenode.tree_lock.write():
+            parent_dir, abs_path, file_name = self.get_file(file_path)
+            if parent_dir is None:
+                return abs_path
+            if file_name not in parent_dir.children_files:
+                return 'File does not exist.'
+            file = parent_dir.children_files[file_name]
+            if file not in self.pending_blocks:
+                return 'Lock is expired.'
+            new_blocks, old_blocks = self.pending_blocks.pop(file), file.blocks
+            for block, report in zip(new_blocks, blocks):
+                block.checksum = report.get('checksum')
+            self.capacity.commit(file)
             self.namenode.release_lock(client_ip, abs_path)
-            return 'There is no available nodes to store file'
-        else:
-            file.new_nodes = selected_nodes
-            return {'ips': list(selected_nodes), 'path': abs_path}
-
-    def replicate_file(self, file_path, client_ip, node_ip):
-        parent_dir, abs_path, file_name = self.get_file(file_path)
-        if parent_dir is None:
-            return abs_path
-        file = parent_dir.children_files[file_name]
-        self.namenode.release_lock(client_ip, abs_path)
-        file.set_write_lock()
-        if node_ip in file.nodes:
-            file.nodes.remove(node_ip)
-        self._delete_file_from_nodes(file)
-        file.nodes = file.new_nodes
-        left_nodes = file.nodes.copy()
-
-        storing_nodes = {node_ip}
-        left_nodes = left_nodes.difference(storing_nodes)
-        while len(left_nodes) > 0 and len(storing_nodes) < self.num_replicas:
-            statuses = {}
-            i = len(storing_nodes)
-            threads = []
-            for storing_node, left_node in zip(storing_nodes, left_nodes):
-                if i >= self.num_replicas:
-                    break
-                args = (statuses, storing_node, left_node, str(file), str(file), self.auth_data)
-                thread = Thread(target=create_replica, args=args)
-                thread.start()
-                threads.append((left_node, storing_node, thread))
-                i += 1
-
-            for thread in threads:
-                thread[-1].join()
-
-            for (dest_node, status), (_, source_node, _) in zip(sorted(statuses.items()), sorted(threads)):
-                left_nodes.remove(dest_node)
-                if status:
-                    storing_nodes.add(dest_node)
-        file.nodes = storing_nodes
-        file.release_write_lock()
+            file.set_write_lock()
+
+        try:
+            plans = [self._replication_plan(block, report['node_ip'], report.get('replicas', ()))
+                     for block, report in zip(new_blocks, blocks)]
+            copies = [(block, report['node_ip'], storing_nodes, left_nodes)
+                      for block, report, (storing_nodes, left_nodes) in zip(new_blocks, blocks, plans) if left_nodes]
+            results = yield NodeCalls([(node_ip, [self.replicate_command(block, left_nodes)])
+                                       for block, node_ip, storing_nodes, left_nodes in copies],
+                                      timeout=self.transfer_timeout(max((copy[0].size for copy in copies), default=0)))
+            for (block, node_ip, storing_nodes, left_nodes), result in zip(copies, results):
+                if result.ok:
+                    storing_nodes.update(result.responses[0].split(': ', 1)[1].split())
+
+            stale_blocks = defaultdict(list)
+            for block, (storing_nodes, left_nodes) in zip(new_blocks, plans):
+                old_nodes = old_blocks[block.index].nodes if block.index < len(old_blocks) else set()
+                for node in old_nodes.union(block.nodes).difference(storing_nodes):
+                    stale_blocks[node].append(f"DELE {block}")
+            for block in old_blocks[len(new_blocks):]:
+                for node in block.nodes:
+                    stale_blocks[node].append(f"DELE {block}")
+            yield FanOut(stale_blocks, lambda node: stale_blocks[node])
+
+            with self.namenode.tree_lock.write():
+                # replicas of blocks forget digests of the tree, so they are changed only under its lock
+                for block, (storing_nodes, left_nodes) in zip(new_blocks, plans):
+                    block.nodes = storing_nodes
+                mtime = time.time()
+                self.namenode.log_edit(*file_edit(file, new_blocks, mtime))
+                file.blocks = new_blocks
+                file.size = sum(block.size for block in new_blocks)
+                file.mtime = mtime
+                for block in new_blocks:
+                    self.namenode.replication.enqueue(block)
+        finally:
+            with self.namenode.tree_lock.write():
+                file.release_write_lock()
         return "File was replicated"
 
-    def _select_datanodes_for_write(self, file, file_size):
-        selected_nodes = set()
-        for node in self.datanodes:
-            try:
-                with FTP(node, **self.auth_data) as ftp:
-                    old_file_size = file.size if node in file.nodes else 0
-                    if int(ftp.sendcmd("AVBL /").split(' ')[4]) - old_file_size > file_size:
-                        selected_nodes.add(node)
-            except ConnectionRefusedError:
-                continue
-        return selected_nodes
-
-    def _delete_file_from_nodes(self, file):
-        deleted_nodes = set()
-        for node in file.nodes:
-            try:
-                with FTP(node, **self.auth_data) as ftp:
-                    ftp.voidcmd(f"DELE {file}")
-                    deleted_nodes.add(node)
-            except ConnectionRefusedError:
-                continue
-        return deleted_nodes
-
-    def _copy_file_on_nodes(self, file, new_file, copy=True):
-        new_file_nodes = set()
-        for node in file.nodes:
-            try:
-                with FTP(node, **self.auth_data) as ftp:
-                    if copy:
-                        ftp.voidcmd(f"CP {file} {new_file}")
-                    else:
-                        ftp.voidcmd(f"MV {file} {new_file}")
-                    new_file_nodes.add(node)
-            except ConnectionRefusedError:
-                continue
-        return new_file_nodes
+    def transfer_timeout(self, size):
+        """Seconds allowed for copying size bytes between datanodes."""
+        return self.fan_out.timeout + size / MIN_TRANSFER_RATE
+
+    @staticmethod
+    def replicate_command(block, nodes):
+        checksum = '-' if block.checksum is None else f'{block.checksum:08x}'
+        return f"REPL {block} {block} {checksum} {' '.join(nodes)}"
+
+    def drop_replicas(self, reporter_ip, block_paths, datanode_ip=None):
+        """Forget replicas of the blocks which were found corrupted or missing on the datanode.
+
+        Datanodes report their own replicas. Clients name the datanode whose replica did not match
+        the checksum while another replica did, so the last replica of a block is never dropped for them.
+        """
+        reporter_ip = datanode_address(reporter_ip)
+        if datanode_ip is None:
+            datanode_ip = reporter_ip
+        with self.namenode.tree_lock.write():
+            for block_path in block_paths:
+                file_path, index = os.path.split(block_path)
+                parent_dir, abs_path, file_name = self.get_file(file_path)
+                if parent_dir is None or file_name not in parent_dir.children_files:
+                    continue
+                file = parent_dir.children_files[file_name]
+                if not index.isdigit() or int(index) >= len(file.blocks):
+                    continue
+                block = file.blocks[int(index)]
+                nodes = block.nodes - {datanode_ip}
+                if (datanode_ip != reporter_ip and not nodes) or nodes == block.nodes:
+                    continue
+                self.namenode.log_edit(*file_edit(file, replicas={block: nodes}))
+                block.nodes = nodes
+                self.namenode.replication.enqueue(block)
+        return ''
+
+    def compare_digests(self, datanode_ip, digests):
+        """Return the expected content of the datanode directories whose digests differ from the namespace.
+
+        A directory is answered with {'d': {name: digest}, 'f': {name: block indices}} of what the
+        datanode should store in it, or None if it is not a directory of the namespace.
+        """
+        datanode_ip = datanode_address(datanode_ip)
+        view = NodeView(datanode_ip)
+        answer = {}
+        with self.namenode.tree_lock.read():
+            for path, digest in digests.items():
+                parent_dir, abs_path, dir_name = self.get_dir(path)
+                if parent_dir is not None and abs_path != str(parent_dir):
+                    parent_dir = parent_dir.children_directories.get(dir_name)
+                if parent_dir is None:
+                    answer[path] = None
+                elif view.digest(parent_dir) != digest:
+                    dirs, files = view.entries(parent_dir)
+                    answer[path] = {'d': dirs, 'f': files}
+        return answer
+
+    def _refresh_capacity(self):
+        unknown_nodes = [node for node in self.datanodes if node not in self.capacity]
+        results = yield FanOut(unknown_nodes, "AVBL /")
+        for node, result in results.items():
+            if result.ok:
+                self.capacity.update(node, int(result.responses[0].split(' ')[4]))
+
+    def _place_blocks(self, file, file_size):
+        blocks = []
+        sizes = defaultdict(int)
+        for index, offset in enumerate(range(0, file_size, self.block_size)):
+            block_size = min(self.block_size, file_size - offset)
+            candidates = [node for node in self.datanodes
+                          if node in self.capacity and self.capacity.available(node) - sizes[node] > block_size]
+            nodes = self.placement.select(candidates, self.num_replicas)
+            if not nodes:
+                return None, None
+            for node in nodes:
+                sizes[node] += block_size
+            blocks.append(Block(file, index, block_size, nodes))
+        return blocks, sizes
+
+    def _delete_file_from_nodes(self, nodes, file_path):
+        results = yield FanOut(nodes, f"RMTREE {file_path}")
+        return FanOutExecutor.succeeded(results)
+
+    def _copy_file_on_nodes(self, nodes, file_path, new_file_path, copy=True):
+        if copy:
+            results = yield FanOut(nodes, f"CP {file_path} {new_file_path}")
+        else:
+            results = yield FanOut(nodes, f"MV {file_path} {new_file_path}")
+        return FanOutExecutor.succeeded(results)
 
     def _get_relocation_info(self, file_path_from, dir_path_to):
         file_parent_dir, file_abs_path, file_name = self.get_file(file_path_from)
@@ -226,7 +336,10 @@ class FTPClient:
         else:
             new_parent_dir = dir_parent_dir
 
-        if file_name in new_parent_dir.children_files:
+        if self._being_deleted(file_parent_dir) or self._being_deleted(new_parent_dir):
+            return None, 'Directory is being deleted.'
+
+        if file_name in new_parent_dir.children_files or (new_parent_dir, file_name) in self.incoming:
             return None, 'File with the same name already exist in directory.'
 
         if not file_parent_dir.children_files[file_name].readable():
@@ -235,189 +348,352 @@ class FTPClient:
         return file_name, file_parent_dir, new_parent_dir
 
     def move_file(self, file_path_from, dir_path_to):
-        result = self._get_relocation_info(file_path_from, dir_path_to)
-        if result[0] is None:
-            return result[1]
-
-        file_name, file_parent_dir, new_parent_dir = result
-        file = file_parent_dir.delete_file(file_name)
+        with self.namenode.tree_lock.write():
+            result = self._get_relocation_info(file_path_from, dir_path_to)
+            if result[0] is None:
+                return result[1]
+
+            file_name, file_parent_dir, new_parent_dir = result
+            file = file_parent_dir.children_files[file_name]
+            old_file_path, new_file_path = str(file), os.path.join(str(new_parent_dir), file_name)
+            # the file stays at its old path until the move is logged, meanwhile its new name is kept
+            # and the new directory cannot be deleted
+            file.set_write_lock()
+            new_parent_dir.set_read_lock()
+            self.incoming.add((new_parent_dir, file_name))
+            nodes = file.nodes
 
         try:
-            new_file_path = os.path.join(str(new_parent_dir), file_name)
-            new_file_nodes = self._copy_file_on_nodes(file, new_file_path, copy=False)
+            new_file_nodes = yield from self._copy_file_on_nodes(nodes, old_file_path, new_file_path, copy=False)
+            with self.namenode.tree_lock.write():
+                self.namenode.log_edit('mv', old_file_path, new_file_path)
+                file_parent_dir.delete_file(file_name)
+                new_parent_dir.attach_file(file)
+                replicas = {block: block.nodes.intersection(new_file_nodes) for block in file.blocks}
+                self.namenode.log_edit(*file_edit(file, replicas=replicas))
+                for block, block_nodes in replicas.items():
+                    block.nodes = block_nodes
+                    self.namenode.replication.enqueue(block)
         except Exception as e:
-            file_parent_dir.children_files[file_name] = file
             return 'File was not moved due to internal error.'
-        new_parent_dir.children_files[file_name] = file
-        file.parent = new_parent_dir
-        file.nodes = new_file_nodes
+        finally:
+            with self.namenode.tree_lock.write():
+                file.release_write_lock()
+                new_parent_dir.release_read_lock()
+                self.incoming.discard((new_parent_dir, file_name))
         return ''
 
     def copy_file(self, file_path_from, dir_path_to):
-        result = self._get_relocation_info(file_path_from, dir_path_to)
-        if result[0] is None:
-            return result[1]
-
-        file_name, file_parent_dir, new_parent_dir = result
-        file_old = file_parent_dir.children_files[file_name]
-
-        file_old.set_read_lock()
-        file_new: File = new_parent_dir.add_file(file_name)
-        file_new.set_write_lock()
+        with self.namenode.tree_lock.write():
+            result = self._get_relocation_info(file_path_from, dir_path_to)
+            if result[0] is None:
+                return result[1]
+
+            file_name, file_parent_dir, new_parent_dir = result
+            file_old = file_parent_dir.children_files[file_name]
+            old_file_path, new_file_path = str(file_old), os.path.join(str(new_parent_dir), file_name)
+            # the copy is attached only once it is logged, as in move_file its name is kept until then
+            file_old.set_read_lock()
+            new_parent_dir.set_read_lock()
+            self.incoming.add((new_parent_dir, file_name))
+            nodes = file_old.nodes
 
         try:
-            new_file_path = os.path.join(str(new_parent_dir), file_name)
-            new_file_nodes = self._copy_file_on_nodes(file_old, new_file_path, copy=True)
+            new_file_nodes = yield from self._copy_file_on_nodes(nodes, old_file_path, new_file_path, copy=True)
+            with self.namenode.tree_lock.write():
+                file_new = File(file_name, new_parent_dir)
+                blocks = [Block(file_new, block.index, block.size, block.nodes.intersection(new_file_nodes),
+                                block.checksum)
+                          for block in file_old.blocks]
+                self.namenode.log_edit(*file_edit(file_new, blocks))
+                file_new.blocks = blocks
+                file_new.size = file_old.size
+                new_parent_dir.attach_file(file_new)
+                for block in blocks:
+                    self.namenode.replication.enqueue(block)
         except Exception as e:
-            file_new.release_write_lock()
-            file_old.release_read_lock()
-            new_parent_dir.delete_file(file_name)
-            return 'File was not moved due to internal error.'
-        file_new.nodes = new_file_nodes
-        file_new.release_write_lock()
-        file_old.release_read_lock()
+            return 'File was not copied due to internal error.'
+        finally:
+            with self.namenode.tree_lock.write():
+                file_old.release_read_lock()
+                new_parent_dir.release_read_lock()
+                self.incoming.discard((new_parent_dir, file_name))
         return ''
 
     def remove_file(self, file_path):
-        parent_dir, abs_path, file_name = self.get_file(file_path)
-        if parent_dir is None:
-            return abs_path
+        with self.namenode.tree_lock.write():
+            parent_dir, abs_path, file_name = self.get_file(file_path)
+            if parent_dir is None:
+                return abs_path
 
-        if file_name not in parent_dir:
-            return 'File does not exist.'
+            if file_name not in parent_dir:
+                return 'File does not exist.'
 
-        file = parent_dir.children_files[file_name]
-        if not file.writable():
-            return 'File is blocked by another process. Deleting cannot be performed.'
+            file = parent_dir.children_files[file_name]
+            if not file.writable():
+                return 'File is blocked by another process. Deleting cannot be performed.'
+
+            file.set_write_lock()
+            nodes = file.nodes
 
-        file.set_write_lock()
-        self._delete_file_from_nodes(file)
-        file.release_write_lock()
-        parent_dir.delete_file(file_name)
+        deleted = False
+        try:
+            yield from self._delete_file_from_nodes(nodes, abs_path)
+            deleted = True
+        finally:
+            with self.namenode.tree_lock.write():
+                file.release_write_lock()
+                if deleted:
+                    self.namenode.log_edit('rm', abs_path)
+                    parent_dir.delete_file(file_name)
         return 'File was deleted'
 
-    def get_info(self, file_path):
-        parent_dir, abs_path, file_name = self.get_file(file_path)
-        if parent_dir is None:
-            return abs_path
-
-        if file_name not in parent_dir:
-            return 'File does not exist.'
-
-        file = parent_dir.children_files[file_name]
-        if not file.readable():
-            return 'File is being written. Reading cannot be performed.'
-
-        file.set_read_lock()
-
-        result = 'File is not accessed'
-        for datanode in file.nodes:
-            try:
-                with FTP(datanode, **self.auth_data) as ftp:
-                    ftp.voidcmd('TYPE I')
-                    size = ftp.size(str(file))
-                    date = ftp.sendcmd(f"MDTM {file}").split(' ')[1]
-                    date = datetime.strptime(date, "%Y%m%d%H%M%S").isoformat(' ')
-                    details = ftp.sendcmd(f"LIST {file}").split(' ', 1)[1]
-
-                    units = ['B', 'KB', 'MB', 'GB', 'TB']
-                    i = 0
-                    while size / 1000 > 2:
-                        i += 1
-                        size /= 1000
-                    result = f"Size of the file is {round(size, 2)} {units[i]}"
-                    result += f'\nLast modified: {date}\n{details}'
-                break
-            except ConnectionRefusedError:
-                continue
-        file.release_read_lock()
+    @staticmethod
+    def _file_stat(file):
+        return {'path': str(file), 'size': file.size, 'mtime': file.mtime, 'nodes': sorted(file.nodes),
+                'checksums': [None if block.checksum is None else f'{block.checksum:08x}' for block in file.blocks],
+                'being_written': not file.readable()}
+
+    def stat_files(self, file_paths):
+        """Metadata of the files kept by the namenode, an error message for paths which are not files."""
+        results = []
+        with self.namenode.tree_lock.read():
+            for file_path in file_paths:
+                parent_dir, abs_path, file_name = self.get_file(file_path)
+                if parent_dir is None:
+                    results.append(abs_path)
+                elif file_name not in parent_dir.children_files:
+                    results.append('File does not exist.')
+                else:
+                    results.append(self._file_stat(parent_dir.children_files[file_name]))
+        return results
+
+    def _verify_replicas(self, blocks):
+        """Ask every replica of the blocks for its checksum, return the number of matching ones and the others."""
+        commands = defaultdict(list)
+        for block in blocks:
+            for node in block.nodes:
+                commands[node].append(block)
+        results = yield FanOut(list(commands), lambda node: [f"CKSM {block}" for block in commands[node]])
+
+        matching = 0
+        mismatching = []
+        for node, node_blocks in commands.items():
+            responses = results[node].responses
+            for i, block in enumerate(node_blocks):
+                response = responses[i] if i < len(responses) else ''
+                if response[:1] == '2' and (block.checksum is None or
+                                            response.split()[-1] == f'{block.checksum:08x}'):
+                    matching += 1
+                else:
+                    mismatching.append(f'block {block.index} on {node}')
+        return matching, mismatching
+
+    def get_info(self, file_path, verify=False):
+        with self.namenode.tree_lock.read():
+            parent_dir, abs_path, file_name = self.get_file(file_path)
+            if parent_dir is None:
+                return abs_path
+
+            if file_name not in parent_dir:
+                return 'File does not exist.'
+
+            file = parent_dir.children_files[file_name]
+            if not file.readable():
+                return 'File is being written. Reading cannot be performed.'
+
+            stat = self._file_stat(file)
+            blocks = list(file.blocks)
+
+        size = stat['size']
+        units = ['B', 'KB', 'MB', 'GB', 'TB']
+        i = 0
+        while size / 1000 > 2:
+            i += 1
+            size /= 1000
+        result = f"Size of the file is {round(size, 2)} {units[i]}"
+        if stat['mtime'] is not None:
+            date = datetime.fromtimestamp(stat['mtime'], timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+            result += f'\nLast modified: {date}'
+        result += f"\nBlocks: {len(blocks)}, datanodes: {', '.join(stat['nodes'])}"
+        if verify:
+            matching, mismatching = yield from self._verify_replicas(blocks)
+            result += f"\nReplicas matching their checksums: {matching} of {matching + len(mismatching)}"
+            if mismatching:
+                result += f"\nMissing or corrupted: {', '.join(mismatching)}"
         return result
 
     def create_directory(self, dir_path):
-        parent_dir, abs_path, dir_name = self.get_dir(dir_path)
+        with self.namenode.tree_lock.write():
+            parent_dir, abs_path, dir_name = self.get_dir(dir_path)
 
-        if parent_dir is None:
-            return abs_path
+            if parent_dir is None:
+                return abs_path
+            if self._being_deleted(parent_dir):
+                return 'Directory is being deleted.'
 
-        if dir_name in parent_dir or abs_path == str(parent_dir):
-            return 'Directory already exist.'
+            if self._name_taken(parent_dir, dir_name) or abs_path == str(parent_dir):
+                return 'Directory already exist.'
 
-        try:
+            self.namenode.log_edit('mkdir', abs_path)
             new_dir = parent_dir.add_directory(dir_name)
+            self.namenode.paths.invalidate(abs_path)
             new_dir.set_write_lock()
 
-            for datanode in self.datanodes:
-                try:
-                    with FTP(datanode, **self.auth_data) as ftp:
-                        ftp.voidcmd(f"MKD {abs_path}")
-                except ConnectionRefusedError:
-                    continue
+        created = False
+        try:
+            yield FanOut(self.datanodes, f"MKD {abs_path}")
+            created = True
         except Exception as e:
-            parent_dir.delete_directory(dir_name)
             return 'Directory was not created due to internal error.'
         finally:
-            new_dir.release_write_lock()
+            with self.namenode.tree_lock.write():
+                new_dir.release_write_lock()
+                if not created:
+                    self.namenode.log_edit('rmdir', abs_path)
+                    parent_dir.delete_directory(dir_name)
+                    self.namenode.paths.invalidate(abs_path)
         return ''
 
     def open_directory(self, dir_path):
-        parent_dir, abs_path, dir_name = self.get_dir(dir_path)
-        if parent_dir is None:
-            return abs_path
+        with self.namenode.tree_lock.write():
+            parent_dir, abs_path, dir_name = self.get_dir(dir_path)
+            if parent_dir is None:
+                return abs_path
 
-        self.namenode.work_dir.release_read_lock()
-        if str(parent_dir) != abs_path:
-            self.namenode.work_dir = parent_dir.children_directories[dir_name]
-        else:
-            self.namenode.work_dir = parent_dir
-        self.namenode.work_dir.set_read_lock()
+            self.namenode.work_dir.release_read_lock()
+            if str(parent_dir) != abs_path:
+                self.namenode.work_dir = parent_dir.children_directories[dir_name]
+            else:
+                self.namenode.work_dir = parent_dir
+            self.namenode.work_dir.set_read_lock()
 
         return ''
 
     def delete_directory(self, dir_path, force_delete=False):
-        parent_dir, abs_path, dir_name = self.get_file(dir_path)
+        with self.namenode.tree_lock.write():
+            parent_dir, abs_path, dir_name = self.get_file(dir_path)
 
-        if parent_dir is None:
-            return abs_path
-        if abs_path == str(parent_dir):
-            return 'You cannot delete root directory.', 0
+            if parent_dir is None:
+                return abs_path
+            if abs_path == str(parent_dir):
+                return 'You cannot delete root directory.', 0
 
-        if dir_name not in parent_dir:
-            return 'Directory does not exist.', 0
+            if dir_name not in parent_dir:
+                return 'Directory does not exist.', 0
 
-        dir = parent_dir.children_directories[dir_name]
-        if not dir.writable():
-            return 'Directory is blocked by another process. Deleting cannot be performed.', 0
+            dir = parent_dir.children_directories[dir_name]
+            if not dir.writable():
+                return 'Directory is blocked by another process. Deleting cannot be performed.', 0
 
-        if (dir.children_directories or dir.children_files) and not force_delete:
-            return 'Directory is not empty. Are you sure to delete it anyway?[Y/n]', 1
+            if (dir.children_directories or dir.children_files) and not force_delete:
+                return 'Directory is not empty. Are you sure to delete it anyway?[Y/n]', 1
 
-        parent_dir.delete_directory(dir_name)
+            # the directory stays in the tree until RMTREE is done, so its path cannot be taken meanwhile
+            dir.set_write_lock()
+            self.deleting.add(dir)
 
-        for datanode in self.datanodes:
-            try:
-                with FTP(datanode, **self.auth_data) as ftp:
-                    ftp.voidcmd(f"RMTREE {abs_path}")
-            except ConnectionRefusedError:
-                continue
+        removed = False
+        try:
+            yield FanOut(self.datanodes, f"RMTREE {abs_path}")
+            removed = True
+        finally:
+            with self.namenode.tree_lock.write():
+                dir.release_write_lock()
+                self.deleting.discard(dir)
+                if removed:
+                    self.namenode.log_edit('rmdir', abs_path)
+                    parent_dir.delete_directory(dir_name)
+                    self.namenode.paths.invalidate(abs_path)
 
         return 'Directory was deleted', 0
 
-    def read_directory(self, dir_path=None):
-        if dir_path is None:
-            parent_dir, abs_path, dir_name = self.get_dir(str(self.namenode.work_dir))
-        else:
-            parent_dir, abs_path, dir_name = self.get_dir(dir_path)
+    def read_directory(self, dir_path=None, start_after=None, limit=None):
+        """List the directory, with a limit only that many names following start_after in sorted order.
+
+        The answer of a limited listing has 'next', the start_after of the next page or None after the last one.
+        """
+        with self.namenode.tree_lock.read():
+            if dir_path is None:
+                parent_dir, abs_path, dir_name = self.get_dir(str(self.namenode.work_dir))
+            else:
+                parent_dir, abs_path, dir_name = self.get_dir(dir_path)
+
+            if parent_dir is None:
+                return abs_path
+
+            if str(parent_dir) != abs_path:
+                if dir_name not in parent_dir:
+                    return 'Directory does not exist.'
+                dir = parent_dir.children_directories[dir_name]
+            else:
+                dir = parent_dir
+            if limit is None:
+                files = [name for name, obj in dir.children_files.items()]
+                dirs = [name for name, obj in dir.children_directories.items()]
+                return {'files': files, 'dirs': dirs}
+
+            names, more = dir.page(start_after, limit)
+            files = [name for name in names if name in dir.children_files]
+            dirs = [name for name in names if name in dir.children_directories]
+        return {'files': files, 'dirs': dirs, 'next': names[-1] if more else None}
+
+    def _start_operation(self, operation, client_ip):
+        op = operation.pop('op', None)
+        if op not in self.batch_operations:
+            return None, f'Operation {op} cannot be batched.'
+        if op in self.client_operations:
+            operation['client_ip'] = client_ip
+        try:
+            answer = self.batch_operations[op](**operation)
+        except TypeError:
+            return None, f'Incorrect arguments of {op}.'
+        except Exception as e:
+            return None, self._failure(op, e)
+        if not hasattr(answer, 'send'):
+            return None, answer
+        try:
+            return answer, next(answer)
+        except StopIteration as stop:
+            return None, stop.value
+        except Exception as e:
+            return None, self._failure(op, e)
 
-        if parent_dir is None:
-            return abs_path
+    @staticmethod
+    def _failure(op, error):
+        return f'Operation {op} failed due to internal error: {error!r}'
 
-        if str(parent_dir) != abs_path:
-            if dir_name not in parent_dir:
-                return 'Directory does not exist.'
-            dir = parent_dir.children_directories[dir_name]
-        else:
-            dir = parent_dir
-        files = [name for name, obj in dir.children_files.items()]
-        dirs = [name for name, obj in dir.children_directories.items()]
+    def batch(self, operations, client_ip):
+        """Run namespace operations of one request and return their results in order.
 
-        return {'files': files, 'dirs': dirs}
+        Operations run one after another until they need datanodes, then the datanode commands
+        of all of them are sent as one command list per node, and so on until all are finished.
+        An operation sees the namespace changes of the previous ones, but not their datanode steps.
+        """
+        results = [None] * len(operations)
+        running = {}
+        try:
+            for i, operation in enumerate(operations):
+                generator, request = self._start_operation(dict(operation), client_ip)
+                if generator is None:
+                    results[i] = request
+                else:
+                    running[i] = (generator, request)
+
+            while running:
+                request, split = coalesce([request for generator, request in running.values()])
+                answers = split((yield request))
+                for (i, (generator, _)), answer in zip(list(running.items()), answers):
+                    try:
+                        running[i] = (generator, generator.send(answer))
+                    except StopIteration as stop:
+                        results[i] = stop.value
+                        del running[i]
+                    except Exception as e:
+                        results[i] = self._failure(operations[i].get('op'), e)
+                        del running[i]
+        finally:
+            # operations left suspended by an abort release their locks in their finally clauses
+            for generator, _ in running.values():
+                generator.close()
+        return results
@@ -1,70 +1,88 @@
 #!/usr/bin/python3.7
 import json
+from collections import namedtuple
 from http.server import BaseHTTPRequestHandler
 
 from .ftp_client import FTPClient
 
 
+# Answer sent as it is produced, in HTTP chunks of the bytes yielded by chunks
+Stream = namedtuple('Stream', ['chunks'])
+
+routes = {
+    '/synchronize': lambda client, ip, args: Stream(client.namenode.stream_fs_tree()) if args.get('stream')
+    else client.namenode.traverse_fs_tree(),
+    '/add_node': lambda client, ip, args: client.namenode.add_datanode(ip),
+    '/metrics': lambda client, ip, args: client.namenode.metrics(),
+    '/heartbeat': lambda client, ip, args: client.namenode.heartbeat(ip, **args),
+    '/compare_digests': lambda client, ip, args: client.compare_digests(ip, **args),
+    '/drop_replicas': lambda client, ip, args: client.drop_replicas(ip, **args),
+    '/init': lambda client, ip, args: client.initialize(),
+    '/create': lambda client, ip, args: client.create_file(**args),
+    '/read': lambda client, ip, args: client.read_file(client_ip=ip, **args),
+    '/update_lock': lambda client, ip, args: client.namenode.update_lock(client_ip=ip, **args),
+    '/release_lock': lambda client, ip, args: client.namenode.release_lock(client_ip=ip, **args),
+    '/rm': lambda client, ip, args: client.remove_file(**args),
+    '/info': lambda client, ip, args: client.get_info(**args),
+    '/stat': lambda client, ip, args: client.stat_files(**args),
+    '/mkdir': lambda client, ip, args: client.create_directory(**args),
+    '/cd': lambda client, ip, args: client.open_directory(**args),
+    '/ls': lambda client, ip, args: client.read_directory(**args),
+    '/rmdir': lambda client, ip, args: client.delete_directory(**args),
+    '/write': lambda client, ip, args: client.write_file(client_ip=ip, **args),
+    '/replicate_file': lambda client, ip, args: client.replicate_file(client_ip=ip, **args),
+    '/copy': lambda client, ip, args: client.copy_file(**args),
+    '/move': lambda client, ip, args: client.move_file(**args),
+    '/batch': lambda client, ip, args: client.batch(client_ip=ip, **args),
+}
+
+
+def route(ftp_client, path, client_ip, args):
+    """Answer of the namenode to the request, operations talking to datanodes return a generator."""
+    operation = routes.get(path)
+    if operation is None:
+        print("Error! Command doesn't exist.")
+        return 'failure'
+    return operation(ftp_client, client_ip, args)
+
+
 class Handler(BaseHTTPRequestHandler):
     ftp_client: FTPClient = None
 
-    def _set_response(self):
+    protocol_version = 'HTTP/1.1'
+    timeout = 120
+    disable_nagle_algorithm = True
+
+    def _send_json(self, msg):
+        payload = json.dumps(msg).encode('utf-8')
         self.send_response(200)
-        self.send_header('Content-type', 'text/html')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
         self.end_headers()
+        self.wfile.write(payload)
 
-    def _form_message(self, args):
-        msg = {'msg': 'success'}
-
-        if self.path == '/synchronize':
-            msg['msg'] = self.ftp_client.namenode.traverse_fs_tree()
-        elif self.path == '/add_node':
-            msg['msg'] = self.ftp_client.namenode.add_datanode(self.client_address[0])
-        elif self.path == '/init':
-            msg['msg'] = self.ftp_client.initialize()
-        elif self.path == '/create':
-            msg['msg'] = self.ftp_client.create_file(**args)
-        elif self.path == '/read':
-            msg['msg'] = self.ftp_client.read_file(client_ip=self.client_address[0], **args)
-        elif self.path == '/update_lock':
-            msg['msg'] = self.ftp_client.namenode.update_lock(client_ip=self.client_address[0], **args)
-        elif self.path == '/release_lock':
-            msg['msg'] = self.ftp_client.namenode.release_lock(client_ip=self.client_address[0], **args)
-        elif self.path == '/rm':
-            msg['msg'] = self.ftp_client.remove_file(**args)
-        elif self.path == '/info':
-            msg['msg'] = self.ftp_client.get_info(**args)
-        elif self.path == '/mkdir':
-            msg['msg'] = self.ftp_client.create_directory(**args)
-        elif self.path == '/cd':
-            msg['msg'] = self.ftp_client.open_directory(**args)
-        elif self.path == '/ls':
-            msg['msg'] = self.ftp_client.read_directory(**args)
-        elif self.path == '/rmdir':
-            msg['msg'] = self.ftp_client.delete_directory(**args)
-        elif self.path == '/write':
-            msg['msg'] = self.ftp_client.write_file(client_ip=self.client_address[0], **args)
-        elif self.path == '/replicate_file':
-            msg['msg'] = self.ftp_client.replicate_file(client_ip=self.client_address[0], **args)
-        elif self.path == '/copy':
-            msg['msg'] = self.ftp_client.copy_file(**args)
-        elif self.path == '/move':
-            msg['msg'] = self.ftp_client.move_file(**args)
-        else:
-            print("Error! Command doesn't exist.")
-            msg['msg'] = 'failure'
-
-        return msg
+    def _send_chunks(self, chunks):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for chunk in chunks:
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+        self.wfile.write(b'0\r\n\r\n')
 
-    def do_GET(self):
-        content_length = int(self.headers['Content-Length'])
+    def do_POST(self):
+        content_length = int(self.headers.get('Content-Length', 0))
 
         post_data = self.rfile.read(content_length)
-        args = json.loads(post_data)
+        args = json.loads(post_data) if post_data else {}
 
         try:
-            msg = self._form_message(args)
-            self._set_response()
-            self.wfile.write(json.dumps(msg).encode('utf-8'))  # send message back to the sender
+            answer = route(self.ftp_client, self.path, self.client_address[0], args)
+            if isinstance(answer, Stream):
+                self._send_chunks(answer.chunks)
+            else:
+                self._send_json({'msg': self.ftp_client.fan_out.drive(answer)})
         except ConnectionResetError:
-            pass
+            self.close_connection = True
+
+    do_GET = do_POST
@@ -0,0 +1,90 @@
+import heapq
+import itertools
+import time
+from threading import Condition
+
+
+class LeaseTable:
+    """Read and write locks held by clients, expired in the order of their deadlines.
+
+    Deadlines live in a min-heap. Renewal only moves the deadline stored in the lease, its heap
+    entry is pushed back with the new deadline when it reaches the top of the heap.
+    """
+
+    def __init__(self, duration, on_expire, max_wait=None):
+        self.duration = duration
+        self.on_expire = on_expire
+        self.max_wait = max_wait
+        self.leases = {}
+        self.heap = []
+        self.sequence = itertools.count()
+        self.condition = Condition()
+        self.acquired = 0
+        self.renewed = 0
+        self.released = 0
+        self.expired = 0
+
+    def acquire(self, client_ip, file, is_write):
+        """Start the lease and return is_write of the lease it replaced, None if there was none."""
+        key = (client_ip, file)
+        deadline = time.monotonic() + self.duration
+        seq = next(self.sequence)
+        with self.condition:
+            previous = self.leases.get(key)
+            self.leases[key] = [deadline, is_write, seq]
+            heapq.heappush(self.heap, (deadline, seq, key))
+            self.acquired += 1
+            if self.heap[0][1] == seq:
+                self.condition.notify()
+        return previous[1] if previous is not None else None
+
+    def renew(self, client_ip, file):
+        with self.condition:
+            lease = self.leases.get((client_ip, file))
+            if lease is None:
+                return False
+            lease[0] = time.monotonic() + self.duration
+            self.renewed += 1
+            return True
+
+    def release(self, client_ip, file):
+        """Drop the lease and return whether it was a write one, None if it has already expired."""
+        with self.condition:
+            lease = self.leases.pop((client_ip, file), None)
+            if lease is None:
+                return None
+            self.released += 1
+            return lease[1]
+
+    def _pop_expired(self, now):
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, seq, key = heapq.heappop(self.heap)
+            lease = self.leases.get(key)
+            if lease is None or lease[2] != seq:
+                continue
+            if lease[0] > now:
+                heapq.heappush(self.heap, (lease[0], seq, key))
+            else:
+                del self.leases[key]
+                expired.append((key, lease[1]))
+        self.expired += len(expired)
+        return expired
+
+    def run(self):
+        while True:
+            with self.condition:
+                now = time.monotonic()
+                expired = self._pop_expired(now)
+                if not expired:
+                    timeout = self.heap[0][0] - now if self.heap else None
+                    if self.max_wait is not None:
+                        timeout = self.max_wait if timeout is None else min(timeout, self.max_wait)
+                    self.condition.wait(timeout)
+            for (client_ip, file), is_write in expired:
+                self.on_expire(file, is_write)
+
+    def stats(self):
+        with self.condition:
+            return {'active': len(self.leases), 'acquired': self.acquired, 'renewed': self.renewed,
+                    'released': self.released, 'expired': self.expired, 'heap_size': len(self.heap)}
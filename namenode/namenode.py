@@ -1,99 +1,177 @@
 import argparse
-import time
-from collections import defaultdict
-from http.server import HTTPServer
+import asyncio
+import json
+from http.server import ThreadingHTTPServer
 from threading import Thread
 
-from namenode.fs_tree import Directory
+from namenode.async_server import AsyncNamenodeServer
+from namenode.edit_log import EditLog
+from namenode.fs_tree import datanode_address
 from namenode.ftp_client import FTPClient
 from namenode.http_handler import Handler
+from namenode.leases import LeaseTable
+from namenode.path_resolver import PathResolver
+from namenode.replication import ReplicationMonitor
+from namenode.rw_lock import RWLock
 
 
-def check_locks(update_time, client_locks, lock_duration):
-    while True:
-        dropped_list = []
-        for user_ip, locked_files in client_locks.items():
-            for file in list(locked_files):
-                lock_start, is_write = locked_files[file]
-                if time.time() - lock_start > lock_duration:
-                    if is_write:
-                        file.release_write_lock()
-                    else:
-                        file.release_read_lock()
-                    locked_files.pop(file)
-            if len(locked_files) == 0:
-                dropped_list.append(user_ip)
-        for user_ip in dropped_list:
-            client_locks.pop(user_ip)
-        time.sleep(update_time)
-        print('Update')
+class NamenodeHTTPServer(ThreadingHTTPServer):
+    request_queue_size = 1024
 
 
 class Namenode:
-    def __init__(self, address, port, num_replicas, lock_duration=300, update_time=200,
-                 **auth_data):
+    def __init__(self, address, port, num_replicas, lock_duration=300, update_time=200, pool_size=4,
+                 node_timeout=10, placement='power_of_two', block_size=64 * 1024 * 1024, meta_dir=None,
+                 checkpoint_edits=100000, path_cache_size=65536, server='threaded', heartbeat_timeout=30,
+                 replication_streams=4, replication_rate=64 * 1024 * 1024, **auth_data):
         self.address = address
         self.port = port
         self.num_replicas = num_replicas
-        self.fs_tree = Directory('/')
+        self.tree_lock = RWLock()
+        self.edit_log = EditLog(meta_dir, checkpoint_edits)
+        self.fs_tree = self.edit_log.load()
         self.fs_tree.set_read_lock()
         self.work_dir = self.fs_tree
-        self.client_locks = defaultdict(dict)
+        self.paths = PathResolver(path_cache_size)
         self.lock_duration = lock_duration
-        self.update_time = update_time
-
-        self.ftp_client = FTPClient(self, num_replicas, **auth_data)
-        Handler.ftp_client = self.ftp_client
-        self.http_server = HTTPServer((address, port), Handler)
+        self.leases = LeaseTable(lock_duration, self.expire_lock, max_wait=update_time)
+        self.replication = ReplicationMonitor(self, heartbeat_timeout, replication_streams, replication_rate)
+
+        self.ftp_client = FTPClient(self, num_replicas, pool_size=pool_size, node_timeout=node_timeout,
+                                    placement=placement, block_size=block_size, **auth_data)
+        if server == 'asyncio':
+            self.http_server = None
+            self.async_server = AsyncNamenodeServer(self.ftp_client, address, port, pool_size=pool_size,
+                                                    node_timeout=node_timeout)
+        else:
+            Handler.ftp_client = self.ftp_client
+            self.http_server = NamenodeHTTPServer((address, port), Handler)
 
     def start(self):
         print("Starting server on port:", self.port)
         try:
             print("Server is available on:", self.address)
-            t = Thread(target=check_locks, args=(self.update_time, self.client_locks, self.lock_duration))
-            t.start()
-            self.http_server.serve_forever()
+            Thread(target=self.leases.run, daemon=True).start()
+            Thread(target=self.replication.run, daemon=True).start()
+            if self.http_server is None:
+                asyncio.run(self.async_server.serve())
+            else:
+                self.http_server.serve_forever()
         except KeyboardInterrupt:
             pass
-        self.http_server.server_close()
+        if self.http_server is not None:
+            self.http_server.server_close()
+        with self.tree_lock.write():
+            self.edit_log.checkpoint(self.fs_tree, wait=True)
+            self.edit_log.close()
+        self.ftp_client.close()
         print("Server is closed")
 
+    def log_edit(self, *edit):
+        """Persist the edit ahead of the tree change it describes, under the write lock of the tree.
+
+        The changes of all the earlier edits are made by then, so this is where the snapshot is taken.
+        It is written in the background, see EditLog.
+        """
+        if self.edit_log.edits >= self.edit_log.checkpoint_edits:
+            self.edit_log.checkpoint(self.fs_tree)
+        self.edit_log.log(*edit)
+
     def traverse_fs_tree(self):
-        return self.fs_tree.to_dict()
+        with self.tree_lock.read():
+            return self.fs_tree.to_dict()
+
+    def stream_fs_tree(self, chunk_size=1000):
+        """JSON lines {"path", "f", "d"} listing every directory, about chunk_size names per chunk.
+
+        The tree lock is released between chunks, so changes made meanwhile may show up in some
+        directories and not in others. Large directories are split into several lines.
+        """
+        stack = [self.fs_tree]
+        directory, start_after = None, None
+        while stack or directory is not None:
+            lines = []
+            names_left = chunk_size
+            with self.tree_lock.read():
+                while names_left > 0 and (stack or directory is not None):
+                    if directory is None:
+                        directory, start_after = stack.pop(), None
+                    names, more = directory.page(start_after, names_left)
+                    files = [name for name in names if name in directory.children_files]
+                    dirs = [name for name in names if name in directory.children_directories]
+                    lines.append(json.dumps({'path': str(directory), 'f': files, 'd': dirs}))
+                    stack.extend(directory.children_directories[name] for name in dirs)
+                    names_left -= max(len(names), 1)
+                    if more:
+                        start_after = names[-1]
+                    else:
+                        directory = None
+            yield ('\n'.join(lines) + '\n').encode('utf-8')
 
     def add_datanode(self, datanode_ip):
-        if datanode_ip == '127.0.0.1':
-            datanode_ip = 'localhost'
-        self.ftp_client.datanodes.add(datanode_ip)
+        datanode_ip = datanode_address(datanode_ip)
+        with self.tree_lock.write():
+            self.ftp_client.datanodes = self.ftp_client.datanodes | {datanode_ip}
+        self.replication.node_added(datanode_ip)
+        return ''
+
+    def heartbeat(self, datanode_ip, free):
+        datanode_ip = datanode_address(datanode_ip)
+        self.ftp_client.capacity.update(datanode_ip, free)
+        if datanode_ip not in self.ftp_client.datanodes:
+            return 'register'
         return ''
 
+    def resolve(self, path):
+        return self.paths.resolve(self.fs_tree, self.work_dir, path)
+
     def set_lock(self, client_ip, file, is_write=False):
         if is_write:
             file.set_write_lock()
         else:
             file.set_read_lock()
 
-        self.client_locks[client_ip][file] = (time.time(), is_write)
+        previous = self.leases.acquire(client_ip, file, is_write)
+        if previous is not None:
+            self.expire_lock(file, previous)
+
+    def expire_lock(self, file, is_write):
+        with self.tree_lock.write():
+            if is_write:
+                file.release_write_lock()
+                self.ftp_client.abort_write(file)
+            else:
+                file.release_read_lock()
 
     def update_lock(self, client_ip, file_path):
-        parent_dir, abs_path = self.work_dir.get_absolute_path(file_path)
-        file_name = file_path.split('/')[-1]
-        file = parent_dir.children_files[file_name]
-        lock_start, is_write = self.client_locks[client_ip][file]
-        self.client_locks[client_ip][file] = (time.time(), is_write)
+        with self.tree_lock.read():
+            parent_dir, abs_path, file_name = self.resolve(file_path)
+            if parent_dir is None:
+                return abs_path
+            if file_name not in parent_dir.children_files:
+                return 'File does not exist.'
+            file = parent_dir.children_files[file_name]
+        if not self.leases.renew(client_ip, file):
+            return 'Lock is expired.'
+        return ''
 
     def release_lock(self, client_ip, file_path):
-        parent_dir, abs_path = self.work_dir.get_absolute_path(file_path)
-        file_name = file_path.split('/')[-1]
-        file = parent_dir.children_files[file_name]
-        lock_start, is_write = self.client_locks[client_ip].pop(file)
-        if is_write:
-            file.release_write_lock()
-        else:
-            file.release_read_lock()
+        with self.tree_lock.write():
+            parent_dir, abs_path, file_name = self.resolve(file_path)
+            if parent_dir is None:
+                return abs_path
+            if file_name not in parent_dir.children_files:
+                return 'File does not exist.'
+            file = parent_dir.children_files[file_name]
+            is_write = self.leases.release(client_ip, file)
+            if is_write is None:
+                return 'Lock is expired.'
+            self.expire_lock(file, is_write)
+        return ''
 
-        if len(self.client_locks[client_ip]) == 0:
-            self.client_locks.pop(client_ip)
+    def metrics(self):
+        return {'leases': self.leases.stats(), 'replication': self.replication.stats(),
+                'late_datanode_calls': len(self.ftp_client.fan_out.late)}
 
 
 if __name__ == '__main__':
@@ -101,15 +179,44 @@ if __name__ == '__main__':
 
     parser.add_argument('--ip', type=str, required=True,
                         help='IP of the Namenode')
+    parser.add_argument('--port', type=int, default=80,
+                        help='Port of the Namenode')
     parser.add_argument('--lock_duration', type=int, required=True,
                         help='Duration of the lock for read or written files')
     parser.add_argument('--update_time', type=int, required=True,
-                        help='Period of checking locks in files')
+                        help='Longest period between checks of expired locks')
     parser.add_argument('--num_replicas', type=int, required=True,
                         help='Number of the replicas in the file system')
+    parser.add_argument('--pool_size', type=int, default=4,
+                        help='Maximum number of FTP connections kept per datanode')
+    parser.add_argument('--node_timeout', type=float, default=10,
+                        help='Seconds to wait for each datanode during parallel operations')
+    parser.add_argument('--placement', type=str, default='power_of_two',
+                        choices=['free_space', 'least_loaded', 'power_of_two'],
+                        help='Policy of choosing datanodes for new replicas')
+    parser.add_argument('--block_size', type=int, default=64 * 1024 * 1024,
+                        help='Size of the file blocks in bytes')
+    parser.add_argument('--meta_dir', type=str, default=None,
+                        help='Directory for the edit log and snapshots of the file system tree')
+    parser.add_argument('--checkpoint_edits', type=int, default=100000,
+                        help='Number of logged edits after which the snapshot is rewritten')
+    parser.add_argument('--path_cache_size', type=int, default=65536,
+                        help='Number of resolved directories kept in the path lookup cache')
+    parser.add_argument('--server', type=str, default='threaded', choices=['threaded', 'asyncio'],
+                        help='Serve requests from a thread per request or from one asyncio event loop')
+    parser.add_argument('--heartbeat_timeout', type=float, default=30,
+                        help='Seconds without heartbeats after which a datanode is considered dead')
+    parser.add_argument('--replication_streams', type=int, default=4,
+                        help='Maximum number of blocks copied at once to restore their replicas')
+    parser.add_argument('--replication_rate', type=int, default=64 * 1024 * 1024,
+                        help='Bytes per second copied to restore replicas, 0 for no limit')
     args = parser.parse_args()
 
-    node = Namenode(args.ip, 80, args.num_replicas, lock_duration=args.lock_duration, update_time=args.update_time,
-                    user="Namenode", passwd="1234576890")
+    node = Namenode(args.ip, args.port, args.num_replicas, lock_duration=args.lock_duration,
+                    update_time=args.update_time, pool_size=args.pool_size, node_timeout=args.node_timeout,
+                    placement=args.placement, block_size=args.block_size, meta_dir=args.meta_dir,
+                    checkpoint_edits=args.checkpoint_edits, path_cache_size=args.path_cache_size, server=args.server,
+                    heartbeat_timeout=args.heartbeat_timeout, replication_streams=args.replication_streams,
+                    replication_rate=args.replication_rate, user="Namenode", passwd="1234576890")
 
     node.start()
@@ -0,0 +1,75 @@
+from collections import OrderedDict
+from threading import Lock
+
+from namenode.fs_tree import Directory
+
+
+class PathResolver:
+    """Resolves client paths to the parent directory and the name of the last component.
+
+    Paths are normalized in one pass over their components, directories found on the way
+    are kept in a bounded LRU cache keyed by their absolute path.
+    """
+
+    def __init__(self, cache_size=65536):
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(work_dir, path):
+        components = [] if path.startswith('/') or work_dir is None else str(work_dir).split('/')
+        components = [component for component in components if component]
+        for component in path.split('/'):
+            if component == '..':
+                if components:
+                    components.pop()
+            elif component and component != '.':
+                components.append(component)
+        return components
+
+    def _directory(self, root, path, components):
+        with self.lock:
+            directory = self.cache.get(path)
+            if directory is not None:
+                self.cache.move_to_end(path)
+                self.hits += 1
+                return directory
+            self.misses += 1
+
+        directory = root
+        for component in components:
+            directory = directory.children_directories.get(component)
+            if not isinstance(directory, Directory):
+                return None
+
+        with self.lock:
+            self.cache[path] = directory
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return directory
+
+    def resolve(self, root, work_dir, path):
+        """Return (parent directory, absolute path, name) or (None, error, None)."""
+        components = self.normalize(work_dir, path)
+        if not components:
+            return root, '/', '/'
+
+        parent_path = '/' + '/'.join(components[:-1])
+        parent_dir = self._directory(root, parent_path, components[:-1])
+        if parent_dir is None:
+            return None, 'Incorrect path', None
+        return parent_dir, '/' + '/'.join(components), components[-1]
+
+    def invalidate(self, path):
+        """Forget the directory and everything cached below it."""
+        with self.lock:
+            prefix = path.rstrip('/') + '/'
+            for cached in [cached for cached in self.cache if cached == path or cached.startswith(prefix)]:
+                del self.cache[cached]
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
@@ -0,0 +1,55 @@
+import random
+from abc import ABC, abstractmethod
+
+
+class PlacementPolicy(ABC):
+    def __init__(self, capacity):
+        self.capacity = capacity
+
+    @abstractmethod
+    def select(self, candidates, count):
+        """Choose at most count of the candidate datanodes for new replicas."""
+
+    def _load(self, node):
+        return self.capacity.outstanding(node), -self.capacity.available(node)
+
+
+class FreeSpacePlacement(PlacementPolicy):
+    """Random choice weighted by the free space of datanodes."""
+
+    def select(self, candidates, count):
+        left = list(candidates)
+        selected = []
+        while left and len(selected) < count:
+            weights = [max(self.capacity.available(node), 1) for node in left]
+            node = random.choices(left, weights)[0]
+            left.remove(node)
+            selected.append(node)
+        return selected
+
+
+class LeastLoadedPlacement(PlacementPolicy):
+    """Datanodes with the least outstanding transfers, the most free ones first."""
+
+    def select(self, candidates, count):
+        return sorted(candidates, key=self._load)[:count]
+
+
+class PowerOfTwoPlacement(PlacementPolicy):
+    """Less loaded of two random datanodes, repeated for every replica."""
+
+    def select(self, candidates, count):
+        left = list(candidates)
+        selected = []
+        while left and len(selected) < count:
+            node = min(random.sample(left, min(2, len(left))), key=self._load)
+            left.remove(node)
+            selected.append(node)
+        return selected
+
+
+placement_policies = {
+    'free_space': FreeSpacePlacement,
+    'least_loaded': LeastLoadedPlacement,
+    'power_of_two': PowerOfTwoPlacement,
+}
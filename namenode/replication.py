@@ -0,0 +1,217 @@
+import heapq
+import itertools
+import math
+import time
+from threading import Condition
+
+from namenode.edit_log import drop_node, file_edit
+
+
+class ReplicationMonitor:
+    """Detects dead datanodes and copies blocks which lost replicas to other datanodes.
+
+    Under-replicated blocks wait in a min-heap ordered by the number of live replicas left, so blocks
+    closest to being lost are copied first. Copies are made with REPL, by at most streams datanodes at
+    once, and every round is stretched so that no more than rate bytes per second are copied.
+    Blocks which cannot be copied yet, because their file is being written or no datanode can take
+    them, wait in the deferred heap and are queued again after a delay doubling on every try.
+    """
+
+    def __init__(self, namenode, heartbeat_timeout=30, streams=4, rate=None, max_attempts=3, retry_delay=5,
+                 max_retry_delay=300):
+        self.namenode = namenode
+        self.heartbeat_timeout = heartbeat_timeout
+        self.streams = streams
+        self.rate = rate
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.heap = []
+        self.queued = {}
+        self.deferred = []
+        self.delays = {}
+        self.attempts = {}
+        self.sequence = itertools.count()
+        self.condition = Condition()
+        self.scan_at = time.monotonic() + heartbeat_timeout
+        self.dead_nodes = set()
+        self.replicated = 0
+        self.copied = 0
+        self.failed = 0
+        self.lost = 0
+
+    def _live_replicas(self, block):
+        return block.nodes.intersection(self.namenode.ftp_client.datanodes)
+
+    def enqueue(self, block):
+        remaining = len(self._live_replicas(block))
+        if remaining >= self.namenode.num_replicas:
+            return
+        with self.condition:
+            if self.queued.get(block, math.inf) <= remaining:
+                return
+            self.queued[block] = remaining
+            heapq.heappush(self.heap, (remaining, next(self.sequence), block))
+            self.condition.notify()
+
+    def node_added(self, datanode_ip):
+        """New space may let blocks which had nowhere to go get their replicas."""
+        with self.condition:
+            self.dead_nodes.discard(datanode_ip)
+            self.scan_at = min(self.scan_at, time.monotonic())
+            self.condition.notify()
+
+    def _defer(self, block):
+        with self.condition:
+            delay = self.delays.get(block, self.retry_delay / 2) * 2
+            self.delays[block] = min(delay, self.max_retry_delay)
+            heapq.heappush(self.deferred, (time.monotonic() + self.delays[block], next(self.sequence), block))
+
+    def _requeue_deferred(self):
+        now = time.monotonic()
+        with self.condition:
+            blocks = []
+            while self.deferred and self.deferred[0][0] <= now:
+                blocks.append(heapq.heappop(self.deferred)[2])
+        if blocks:
+            with self.namenode.tree_lock.read():
+                for block in blocks:
+                    self.enqueue(block)
+
+    def _files(self):
+        stack = [self.namenode.fs_tree]
+        while stack:
+            directory = stack.pop()
+            yield from directory.children_files.values()
+            stack.extend(directory.children_directories.values())
+
+    def scan(self):
+        with self.namenode.tree_lock.read():
+            self.attempts.clear()
+            with self.condition:
+                self.delays.clear()
+            for file in self._files():
+                for block in file.blocks:
+                    self.enqueue(block)
+
+    def check_nodes(self):
+        client = self.namenode.ftp_client
+        if not client.capacity.stale(self.heartbeat_timeout).intersection(client.datanodes):
+            return
+
+        # the set of datanodes is changed under the write lock of the tree, as in Namenode.add_datanode,
+        # and a node which reported meanwhile is not stale any more
+        with self.namenode.tree_lock.write():
+            dead = client.capacity.stale(self.heartbeat_timeout).intersection(client.datanodes)
+            client.datanodes = client.datanodes - dead
+            for node in dead:
+                client.capacity.forget(node)
+                client.pool.discard(node)
+            with self.condition:
+                self.dead_nodes.update(dead)
+
+            # one edit per dead node instead of one per file keeps the tree lock short, replay walks the tree
+            for node in dead:
+                self.namenode.log_edit('drop_node', node)
+                for block in drop_node(self.namenode.fs_tree, node):
+                    self.enqueue(block)
+
+    def _next_blocks(self):
+        with self.condition:
+            blocks = []
+            while self.heap and len(blocks) < self.streams:
+                remaining, _, block = heapq.heappop(self.heap)
+                if self.queued.get(block) == remaining:
+                    del self.queued[block]
+                    blocks.append(block)
+            return blocks
+
+    def _attached(self, file):
+        node = file
+        while node.parent is not None:
+            siblings = node.parent.children_files if node is file else node.parent.children_directories
+            if siblings.get(node.name) is not node:
+                return False
+            node = node.parent
+        return node is self.namenode.fs_tree
+
+    def _plan(self, block):
+        client = self.namenode.ftp_client
+        file = block.file
+        if not self._attached(file) or block.index >= len(file.blocks) or file.blocks[block.index] is not block:
+            return None
+        if not file.readable():
+            self._defer(block)
+            return None
+
+        sources = self._live_replicas(block)
+        if not sources:
+            self.lost += 1
+            return None
+        candidates = [node for node in client.datanodes if node not in block.nodes and node in client.capacity
+                      and client.capacity.available(node) > block.size]
+        targets = client.placement.select(candidates, self.namenode.num_replicas - len(sources))
+        if not targets:
+            self._defer(block)
+            return None
+        file.set_read_lock()
+        return block, str(block), min(sources, key=client.capacity.outstanding), targets
+
+    def replicate(self, blocks):
+        """Copy the blocks in one round and return the number of copied bytes."""
+        client = self.namenode.ftp_client
+        with self.namenode.tree_lock.write():
+            plans = [plan for plan in map(self._plan, blocks) if plan is not None]
+        timeout = client.transfer_timeout(max((block.size for block, path, source, targets in plans), default=0))
+        results = client.fan_out.run_each([(source, [client.replicate_command(block, targets)])
+                                           for block, path, source, targets in plans], timeout=timeout)
+
+        copied = 0
+        with self.namenode.tree_lock.write():
+            for (block, path, source, targets), result in zip(plans, results):
+                block.file.release_read_lock()
+                if result.ok and str(block) == path:
+                    replicas = set(result.responses[0].split(': ', 1)[1].split())
+                    nodes = self._live_replicas(block).union(replicas)
+                    self.namenode.log_edit(*file_edit(block.file, replicas={block: nodes}))
+                    block.nodes = nodes
+                    self.replicated += 1
+                    with self.condition:
+                        self.delays.pop(block, None)
+                    copied += block.size * len(replicas)
+                else:
+                    self.failed += 1
+                    self.attempts[block] = self.attempts.get(block, 0) + 1
+                    if self.attempts[block] >= self.max_attempts:
+                        continue
+                self.enqueue(block)
+        self.copied += copied
+        return copied
+
+    def run(self):
+        while True:
+            self.check_nodes()
+            if time.monotonic() >= self.scan_at:
+                self.scan_at = math.inf
+                self.scan()
+            self._requeue_deferred()
+
+            blocks = self._next_blocks()
+            if not blocks:
+                with self.condition:
+                    if not self.heap:
+                        wake_at = min(self.scan_at, self.deferred[0][0] if self.deferred else math.inf)
+                        timeout = min(self.heartbeat_timeout / 3, max(wake_at - time.monotonic(), 0))
+                        self.condition.wait(timeout)
+                continue
+
+            started = time.monotonic()
+            copied = self.replicate(blocks)
+            if self.rate:
+                time.sleep(max(copied / self.rate - (time.monotonic() - started), 0))
+
+    def stats(self):
+        with self.condition:
+            return {'queued': len(self.queued), 'deferred': len(self.deferred), 'dead_nodes': sorted(self.dead_nodes),
+                    'replicated': self.replicated, 'copied_bytes': self.copied, 'failed': self.failed,
+                    'lost': self.lost}
@@ -0,0 +1,59 @@
+from contextlib import contextmanager
+from threading import Condition, get_ident, local
+
+
+class RWLock:
+    """Readers-writer lock preferring writers.
+
+    Both sides are reentrant: the writer may take the lock again for reading or writing, and a
+    reader may take further read locks without waiting behind queued writers.
+    """
+
+    def __init__(self):
+        self.condition = Condition()
+        self.readers = 0
+        self.writer = None
+        self.write_depth = 0
+        self.waiting_writers = 0
+        self.local = local()
+
+    @contextmanager
+    def read(self):
+        with self.condition:
+            counted = self.writer != get_ident()
+            if counted:
+                depth = getattr(self.local, 'depth', 0)
+                if depth == 0:
+                    while self.writer is not None or self.waiting_writers:
+                        self.condition.wait()
+                self.readers += 1
+                self.local.depth = depth + 1
+        try:
+            yield
+        finally:
+            if counted:
+                with self.condition:
+                    self.readers -= 1
+                    self.local.depth -= 1
+                    if self.readers == 0:
+                        self.condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        me = get_ident()
+        with self.condition:
+            if self.writer != me:
+                self.waiting_writers += 1
+                while self.writer is not None or self.readers:
+                    self.condition.wait()
+                self.waiting_writers -= 1
+                self.writer = me
+            self.write_depth += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.write_depth -= 1
+                if self.write_depth == 0:
+                    self.writer = None
+                    self.condition.notify_all()
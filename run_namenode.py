@@ -6,15 +6,44 @@ if __name__ == '__main__':
 
     parser.add_argument('--ip', type=str, required=True,
                         help='IP of the Namenode')
+    parser.add_argument('--port', type=int, default=80,
+                        help='Port of the Namenode')
     parser.add_argument('--lock_duration', type=int, required=True,
                         help='Duration of the lock for read or written files')
     parser.add_argument('--update_time', type=int, required=True,
-                        help='Period of checking locks in files')
+                        help='Longest period between checks of expired locks')
     parser.add_argument('--num_replicas', type=int, required=True,
                         help='Number of the replicas in the file system')
+    parser.add_argument('--pool_size', type=int, default=4,
+                        help='Maximum number of FTP connections kept per datanode')
+    parser.add_argument('--node_timeout', type=float, default=10,
+                        help='Seconds to wait for each datanode during parallel operations')
+    parser.add_argument('--placement', type=str, default='power_of_two',
+                        choices=['free_space', 'least_loaded', 'power_of_two'],
+                        help='Policy of choosing datanodes for new replicas')
+    parser.add_argument('--block_size', type=int, default=64 * 1024 * 1024,
+                        help='Size of the file blocks in bytes')
+    parser.add_argument('--meta_dir', type=str, default=None,
+                        help='Directory for the edit log and snapshots of the file system tree')
+    parser.add_argument('--checkpoint_edits', type=int, default=100000,
+                        help='Number of logged edits after which the snapshot is rewritten')
+    parser.add_argument('--path_cache_size', type=int, default=65536,
+                        help='Number of resolved directories kept in the path lookup cache')
+    parser.add_argument('--server', type=str, default='threaded', choices=['threaded', 'asyncio'],
+                        help='Serve requests from a thread per request or from one asyncio event loop')
+    parser.add_argument('--heartbeat_timeout', type=float, default=30,
+                        help='Seconds without heartbeats after which a datanode is considered dead')
+    parser.add_argument('--replication_streams', type=int, default=4,
+                        help='Maximum number of blocks copied at once to restore their replicas')
+    parser.add_argument('--replication_rate', type=int, default=64 * 1024 * 1024,
+                        help='Bytes per second copied to restore replicas, 0 for no limit')
     args = parser.parse_args()
 
-    node = Namenode(args.ip, 80, args.num_replicas, lock_duration=args.lock_duration, update_time=args.update_time,
-                    user="Namenode", passwd="1234576890")
+    node = Namenode(args.ip, args.port, args.num_replicas, lock_duration=args.lock_duration,
+                    update_time=args.update_time, pool_size=args.pool_size, node_timeout=args.node_timeout,
+                    placement=args.placement, block_size=args.block_size, meta_dir=args.meta_dir,
+                    checkpoint_edits=args.checkpoint_edits, path_cache_size=args.path_cache_size, server=args.server,
+                    heartbeat_timeout=args.heartbeat_timeout, replication_streams=args.replication_streams,
+                    replication_rate=args.replication_rate, user="Namenode", passwd="1234576890")
 
     node.start()
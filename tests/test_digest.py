@@ -0,0 +1,53 @@
+import unittest
+
+from namenode.digest import NodeView, entries_digest
+from namenode.edit_log import drop_node
+from namenode.fs_tree import Block, Directory
+
+
+def fresh_digest(node, directory):
+    dirs = {name: fresh_digest(node, child) for name, child in directory.children_directories.items()}
+    files = {name: [block.index for block in file.blocks if node in block.nodes]
+             for name, file in directory.children_files.items()}
+    return entries_digest(dirs, {name: indices for name, indices in files.items() if indices})
+
+
+class DigestTest(unittest.TestCase):
+    def setUp(self):
+        self.root = Directory('/')
+        self.a = self.root.add_directory('a')
+        self.b = self.a.add_directory('b')
+        self.file = self.b.add_file('f')
+        self.file.blocks = [Block(self.file, 0, 10, ['n1', 'n2']), Block(self.file, 1, 5, ['n2'])]
+        self.other = self.root.add_file('g')
+        self.other.blocks = [Block(self.other, 0, 10, ['n1'])]
+
+    def assertFresh(self):
+        for node in ('n1', 'n2', 'n3'):
+            for directory in (self.root, self.a, self.b):
+                self.assertEqual(NodeView(node).digest(directory), fresh_digest(node, directory))
+
+    def test_changes_are_seen(self):
+        changes = [
+            lambda: setattr(self.file.blocks[1], 'nodes', ['n1', 'n3']),
+            lambda: self.file.blocks[0].drop_node('n2'),
+            lambda: setattr(self.file, 'blocks', [Block(self.file, 0, 1, ['n3'])]),
+            lambda: self.a.attach_file(self.b.delete_file('f')),
+            lambda: self.b.add_directory('c'),
+            lambda: self.b.delete_directory('c'),
+            lambda: drop_node(self.root, 'n1'),
+        ]
+        self.assertFresh()
+        for change in changes:
+            change()
+            self.assertFresh()
+
+    def test_unchanged_subtrees_are_kept(self):
+        NodeView('n1').digest(self.root)
+        self.other.blocks[0].nodes = ['n2']
+        self.assertIsNone(self.root.digests)
+        self.assertIn(NodeView('n1').id, self.b.digests)
+
+
+if __name__ == '__main__':
+    unittest.main()
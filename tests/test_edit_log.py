@@ -0,0 +1,180 @@
+import os
+import tempfile
+import unittest
+
+from namenode.edit_log import EditLog, file_edit
+from namenode.fan_out import FanOut, NodeResult
+from namenode.fs_tree import Block, File
+from namenode.namenode import Namenode
+
+
+def names(directory):
+    return sorted(directory.children_directories), sorted(directory.children_files)
+
+
+class EditLogTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.meta_dir = self.temp_dir.name
+        self.edits_path = os.path.join(self.meta_dir, 'edits')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def reload(self, checkpoint_edits=100000):
+        edit_log = EditLog(self.meta_dir, checkpoint_edits)
+        return edit_log, edit_log.load()
+
+    def test_replay(self):
+        edit_log, root = self.reload()
+        edit_log.log('mkdir', '/a')
+        edit_log.log('mkdir', '/b')
+        file = File('f', root)
+        edit_log.log(*file_edit(file, [Block(file, 0, 10, ['n1', 'n2'], 7), Block(file, 1, 5, ['n2'])], 1.5))
+        edit_log.log('mv', '/f', '/a/g')
+        edit_log.log('rmdir', '/b')
+        edit_log.close()
+
+        edit_log, root = self.reload()
+        self.assertEqual(names(root), (['a'], []))
+        file = root.children_directories['a'].children_files['g']
+        self.assertEqual(file.size, 15)
+        self.assertEqual(file.mtime, 1.5)
+        self.assertEqual([(block.size, block.nodes, block.checksum) for block in file.blocks],
+                         [(10, {'n1', 'n2'}, 7), (5, {'n2'}, None)])
+        self.assertEqual(edit_log.txid, 5)
+
+    def test_drop_node(self):
+        edit_log, root = self.reload()
+        edit_log.log('mkdir', '/a')
+        directory = root.add_directory('a')
+        for parent, name, nodes in [(root, 'f', ['n1', 'n2']), (directory, 'g', ['n2']), (directory, 'h', ['n3'])]:
+            file = File(name, parent)
+            edit_log.log(*file_edit(file, [Block(file, 0, 1, nodes)]))
+        edit_log.log('drop_node', 'n2')
+        edit_log.close()
+
+        edit_log, root = self.reload()
+        directory = root.children_directories['a']
+        self.assertEqual(root.children_files['f'].blocks[0].nodes, {'n1'})
+        self.assertEqual(directory.children_files['g'].blocks[0].nodes, set())
+        self.assertEqual(directory.children_files['h'].blocks[0].nodes, {'n3'})
+
+    def test_replay_after_checkpoint(self):
+        edit_log, root = self.reload()
+        edit_log.log('mkdir', '/a')
+        root.add_directory('a')
+        edit_log.checkpoint(root)
+        # logged while the snapshot may still be written, the log keeps only what the snapshot lacks
+        edit_log.log('mkdir', '/a/b')
+        edit_log.close()
+        with open(self.edits_path, 'rb') as log:
+            self.assertEqual(log.read(), b'[2, "mkdir", "/a/b"]\n')
+
+        edit_log, root = self.reload()
+        self.assertEqual(names(root), (['a'], []))
+        self.assertEqual(names(root.children_directories['a']), (['b'], []))
+        self.assertEqual(edit_log.txid, 2)
+
+    def test_torn_tail(self):
+        edit_log, root = self.reload()
+        edit_log.log('mkdir', '/a')
+        edit_log.close()
+        # complete JSON, but the newline never reached the disk
+        with open(self.edits_path, 'ab') as log:
+            log.write(b'[2, "mkdir", "/b"]')
+
+        edit_log, root = self.reload()
+        self.assertEqual(names(root), (['a'], []))
+        edit_log.log('mkdir', '/c')
+        edit_log.log('mkdir', '/d')
+        edit_log.close()
+
+        edit_log, root = self.reload()
+        self.assertEqual(names(root), (['a', 'c', 'd'], []))
+        with open(self.edits_path, 'rb') as log:
+            self.assertEqual([line[:3] for line in log], [b'[1,', b'[2,', b'[3,'])
+
+    def test_garbage_tail(self):
+        edit_log, root = self.reload()
+        edit_log.log('mkdir', '/a')
+        edit_log.close()
+        with open(self.edits_path, 'ab') as log:
+            log.write(b'[2, "mkd')
+
+        edit_log, root = self.reload()
+        edit_log.log('mkdir', '/b')
+        edit_log.close()
+
+        edit_log, root = self.reload()
+        self.assertEqual(names(root), (['a', 'b'], []))
+
+
+def answer(request):
+    """Results of a datanode request in which every datanode succeeded."""
+    nodes = request.nodes if isinstance(request, FanOut) else [node for node, _ in request.calls]
+    results = [NodeResult(True, ['250 Done'], None) for _ in nodes]
+    return dict(zip(nodes, results)) if isinstance(request, FanOut) else results
+
+
+def finish(operation, request):
+    try:
+        while True:
+            request = operation.send(answer(request))
+    except StopIteration as stop:
+        return stop.value
+
+
+class OperationLogTest(unittest.TestCase):
+    """Operations of FTPClient against the log, a crash is a load of the metadata as it is on disk."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.namenode = Namenode('127.0.0.1', 0, 2, meta_dir=self.temp_dir.name, checkpoint_edits=3,
+                                 server='asyncio')
+        self.client = self.namenode.ftp_client
+        self.client.datanodes = {'n1', 'n2'}
+        mkdir = self.client.create_directory('/a')
+        finish(mkdir, next(mkdir))
+        self.client.create_file('/f')
+        file = self.namenode.fs_tree.children_files['f']
+        blocks = [Block(file, 0, 10, ['n1', 'n2'])]
+        self.namenode.log_edit(*file_edit(file, blocks))
+        file.blocks = blocks
+
+    def tearDown(self):
+        self.namenode.edit_log.close()
+        self.temp_dir.cleanup()
+
+    def crash(self):
+        return EditLog(self.temp_dir.name).load()
+
+    def test_checkpoint_during_move(self):
+        move = self.client.move_file('/f', '/a')
+        request = next(move)
+        self.assertEqual(self.client.create_file('/a/f'), 'File already exists.')
+        self.namenode.edit_log.checkpoint(self.namenode.fs_tree, wait=True)
+        root = self.crash()
+        self.assertEqual(names(root), (['a'], ['f']))
+        self.assertEqual(names(root.children_directories['a']), ([], []))
+
+        self.assertEqual(finish(move, request), '')
+        root = self.crash()
+        self.assertEqual(names(root), (['a'], []))
+        self.assertEqual(root.children_directories['a'].children_files['f'].blocks[0].nodes, {'n1', 'n2'})
+
+    def test_checkpoint_during_copy(self):
+        copy = self.client.copy_file('/f', '/a')
+        request = next(copy)
+        self.namenode.edit_log.checkpoint(self.namenode.fs_tree, wait=True)
+        root = self.crash()
+        self.assertEqual(names(root.children_directories['a']), ([], []))
+
+        self.assertEqual(finish(copy, request), '')
+        root = self.crash()
+        self.assertEqual(names(root), (['a'], ['f']))
+        self.assertEqual(root.children_directories['a'].children_files['f'].blocks[0].nodes, {'n1', 'n2'})
+
+
+if __name__ == '__main__':
+    unittest.main()
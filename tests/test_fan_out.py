@@ -0,0 +1,69 @@
+import threading
+import time
+import unittest
+from contextlib import contextmanager
+
+from namenode.fan_out import FanOutExecutor
+
+
+class FakeFTP:
+    """Connection answering every command after the delay of its node."""
+
+    class sock:
+        @staticmethod
+        def settimeout(timeout):
+            pass
+
+    def __init__(self, delay, executed):
+        self.delay = delay
+        self.executed = executed
+
+    def voidcmd(self, command):
+        time.sleep(self.delay)
+        self.executed.append(command)
+        return '250 Done'
+
+
+class FakePool:
+    def __init__(self, delays):
+        self.delays = delays
+        self.executed = []
+
+    @contextmanager
+    def connection(self, node):
+        yield FakeFTP(self.delays.get(node, 0), self.executed)
+
+
+class FanOutExecutorTest(unittest.TestCase):
+    def test_queued_calls_do_not_time_out(self):
+        pool = FakePool({f'n{index}': 0.2 for index in range(4)})
+        executor = FanOutExecutor(pool, max_workers=8, timeout=0.5)
+        results = []
+
+        def request(index):
+            results.extend(executor.run([f'n{node}' for node in range(4)], f'NOOP {index}').values())
+
+        threads = [threading.Thread(target=request, args=(index,)) for index in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        executor.shutdown()
+        self.assertEqual(len(results), 32)
+        self.assertTrue(all(result.ok for result in results))
+        self.assertEqual(len(pool.executed), 32)
+
+    def test_started_call_times_out(self):
+        executor = FanOutExecutor(FakePool({'slow': 1}), timeout=0.2)
+        start = time.monotonic()
+        results = executor.run(['slow', 'fast'], 'NOOP')
+        self.assertLess(time.monotonic() - start, 0.8)
+        self.assertFalse(results['slow'].ok)
+        self.assertIsInstance(results['slow'].error, TimeoutError)
+        self.assertTrue(results['fast'].ok)
+        self.assertEqual(len(executor.late), 1)
+        executor.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()